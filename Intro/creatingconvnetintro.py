@@ -13,7 +13,8 @@ Here we are going to create a convolutinal neural network following the [source]
 ## Unzip the data
 """
 
-!unzip drive/MyDrive/Colab\ Notebooks/PetImages
+# In Colab run this cell once (it's a shell command, so it is a comment in the .py file):
+# !unzip drive/MyDrive/Colab\ Notebooks/PetImages
 
 """## Preprocessing the data
 
@@ -23,10 +24,10 @@ detailed explanation in the `IntroConvnet.py` file.
 """
 
 import os #functions for creating and removing a directory
-import cv2 #OpenCV packages for Python
+import hashlib
 import numpy as np #to deal w/ arrays
-from tqdm import tqdm #for progress bars
 
+"""`cv2` and `tqdm` are imported inside the functions that use them, and nothing below runs on import: the data is built, split and trained on in `main()` at the end. This way other scripts can `import creatingconvnetintro` just to get `Net` or `DataSplits` quickly."""
 
 REBUILD_DATA = True # set to true to one once, then back to false unless you want to change something in your training data.
 
@@ -36,21 +37,26 @@ class DogsVSCats():
     DOGS = "PetImages/Dog"
     TESTING = "PetImages/Testing"
     LABELS = {CATS: 0, DOGS: 1}
+    SEED = 0 # the same shuffle on every rebuild, so the saved splits still point to the same images
     training_data = []
+    paths = [] # the file of every sample, for the error analysis at the end
 
     catcount = 0
     dogcount = 0
 
     def make_training_data(self):
+        import cv2 #OpenCV packages for Python
+        from tqdm import tqdm #for progress bars
         for label in self.LABELS:
             print(label)
-            for f in tqdm(os.listdir(label)):
+            for f in tqdm(sorted(os.listdir(label))): # listdir has no fixed order
                 if "jpg" in f:
                     try:
                         path = os.path.join(label, f)
                         img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
                         img = cv2.resize(img, (self.IMG_SIZE, self.IMG_SIZE))
                         self.training_data.append([np.array(img), np.eye(2)[self.LABELS[label]]])  # do something like print(np.eye(2)[1]), just makes one_hot 
+                        self.paths.append(path)
                         #print(np.eye(2)[self.LABELS[label]])
 
                         if label == self.CATS:
@@ -62,18 +68,23 @@ class DogsVSCats():
                         pass
                         #print(label, f, str(e))
 
-        np.random.shuffle(self.training_data)
+        order = np.random.default_rng(self.SEED).permutation(len(self.training_data)) # shuffles the data and the paths the same way
+        self.training_data = [self.training_data[i] for i in order]
+        self.paths = [self.paths[i] for i in order]
         np.save("training_data.npy", self.training_data)
-        print('Cats:',dogsvcats.catcount)
-        print('Dogs:',dogsvcats.dogcount)
+        np.save("training_paths.npy", np.array(self.paths))
+        print('Cats:',self.catcount)
+        print('Dogs:',self.dogcount)
 
-if REBUILD_DATA:
-    dogsvcats = DogsVSCats()
-    dogsvcats.make_training_data()
+def load_training_data(rebuild=REBUILD_DATA):
+    if rebuild:
+        dogsvcats = DogsVSCats()
+        dogsvcats.make_training_data()
 
 
-training_data = np.load("training_data.npy", allow_pickle=True)
-print(len(training_data))
+    training_data = np.load("training_data.npy", allow_pickle=True)
+    print(len(training_data))
+    return training_data
 
 """## Importing Modules"""
 
@@ -182,8 +193,6 @@ class Net(nn.Module):
         return F.softmax(x, dim=1)
 
 
-net = Net()
-
 """# Training The Model
 
 We need to make a training loop. For this, we need a loss metric and optimizer.
@@ -193,8 +202,10 @@ We need to make a training loop. For this, we need a loss metric and optimizer.
 
 import torch.optim as optim
 
-optimizer = optim.Adam(net.parameters(), lr=0.001)
-loss_function = nn.MSELoss() #since we have one_hot vectors we use MSE
+def get_optimizer(net):
+    optimizer = optim.Adam(net.parameters(), lr=0.001)
+    loss_function = nn.MSELoss() #since we have one_hot vectors we use MSE
+    return optimizer, loss_function
 
 """## Iterating over data
 
@@ -206,9 +217,11 @@ We need to do this in batches. We will seperate the data to train and test group
 
 """
 
-x = torch. Tensor([i[0] for i in training_data]).view(-1, 50, 50)
-x = x/255.0 #making the values between 0 and 1
-y = torch.Tensor([i[1] for i in training_data])
+def to_tensors(training_data):
+    x = torch. Tensor([i[0] for i in training_data]).view(-1, 50, 50)
+    x = x/255.0 #making the values between 0 and 1
+    y = torch.Tensor([i[1] for i in training_data])
+    return x, y
 
 """## Seperating training and testing data
 
@@ -218,19 +231,127 @@ Separate out some of the data for validation/out of sample testing.
 """
 
 VAL_PCT = 0.1 #testing over 10% of dataset
-val_size = int(len(x)*VAL_PCT)
-print(val_size)
 
-"""Train x and y up to the `-val_size`. and test them from `-val_size` on."""
+"""## Reproducible splits
+
+Slicing with `x[:-val_size]` only works because the data was shuffled when it was rebuilt, so every time you set `REBUILD_DATA = True` you get a different test set and the results of two runs can't really be compared.
+
+Instead we keep the split as index arrays and save them next to the data. The `DataSplits` class below:
+
+- *seed*
+
+  makes the permutation the same on every run.
+- *stratify*
 
-train_x = x[:-val_size] 
-train_y = y[:-val_size]
+  splits every class separately, so cats and dogs keep the same ratio in train, val and test.
+- *arrange(x, y)*
 
-test_x = x[-val_size:]
-test_y = y[-val_size:]
+  reorders the data once so that each split is a contiguous block. After that `train_x`, `test_x`, ... are just views (`x[a:b]`) over the same storage, nothing gets copied again.
 
-print(len(train_x))
-print(len(test_x))
+Once `splits.npz` exists it is loaded instead of being created again. The file also keeps the settings (`val_pct`, `test_pct`, `seed`) and a *fingerprint* of the data (a hash of the labels, and of the file paths if we have them). If one of them changed, the indices would point to other images, so `load_or_create` makes a new split instead (and tells you why). The rebuild of `training_data.npy` is seeded too (`DogsVSCats.SEED`), so rebuilding the same folders gives the same order and the split is kept.
+"""
+
+class DataSplits():
+    NAMES = ("train", "val", "test")
+
+    def __init__(self, n, val_pct=0.1, test_pct=0.0, seed=0, labels=None, keys=None):
+        self.n = n
+        self.val_pct = val_pct
+        self.test_pct = test_pct
+        self.seed = seed
+        self.fingerprint = self.fingerprint_of(n, labels, keys)
+        rng = np.random.default_rng(seed)
+        if labels is None:
+            groups = [np.arange(n)] # the whole dataset is one group
+        else:
+            labels = np.asarray(labels)
+            groups = [np.flatnonzero(labels == c) for c in np.unique(labels)] # one group per class
+        parts = {name: [] for name in self.NAMES}
+        for group in groups:
+            group = rng.permutation(group)
+            n_val = int(len(group)*val_pct)
+            n_test = int(len(group)*test_pct)
+            parts["val"].append(group[:n_val])
+            parts["test"].append(group[n_val:n_val+n_test])
+            parts["train"].append(group[n_val+n_test:])
+        # sorting keeps the order of the original data inside every split
+        self.indices = {name: np.sort(np.concatenate(parts[name])).astype(np.int64) for name in self.NAMES}
+
+    @classmethod
+    def load(cls, path):
+        splits = cls.__new__(cls)
+        with np.load(path) as data:
+            splits.n = int(data["n"])
+            splits.seed = int(data["seed"])
+            splits.val_pct = float(data["val_pct"])
+            splits.test_pct = float(data["test_pct"])
+            splits.fingerprint = str(data["fingerprint"]) if "fingerprint" in data else None # older files have none
+            splits.indices = {name: data[name] for name in cls.NAMES}
+        return splits
+
+    @staticmethod
+    def fingerprint_of(n, labels=None, keys=None):
+        """A hash of the data: its size, the labels and the keys (e.g. file paths) of every sample."""
+        digest = hashlib.sha1(str(n).encode())
+        if labels is not None:
+            digest.update(np.ascontiguousarray(labels, dtype=np.int64).tobytes())
+        if keys is not None:
+            digest.update("\n".join(str(k) for k in keys).encode())
+        return digest.hexdigest()
+
+    def mismatch(self, n, val_pct=0.1, test_pct=0.0, seed=0, labels=None, keys=None):
+        """What is different between these splits and the requested ones (an empty list if nothing)."""
+        wanted = {"n": n, "val_pct": val_pct, "test_pct": test_pct, "seed": seed,
+                  "fingerprint": self.fingerprint_of(n, labels, keys)}
+        return [name for name, value in wanted.items() if getattr(self, name) != value]
+
+    @classmethod
+    def load_or_create(cls, path, n, **kwargs):
+        if os.path.exists(path):
+            splits = cls.load(path)
+            changed = splits.mismatch(n, **kwargs)
+            if not changed:
+                return splits
+            print(f"{path} was made for other data or settings ({', '.join(changed)} changed), making a new split")
+        splits = cls(n, **kwargs)
+        splits.save(path)
+        return splits
+
+    def save(self, path):
+        np.savez(path, n=self.n, seed=self.seed, val_pct=self.val_pct, test_pct=self.test_pct,
+                 fingerprint=self.fingerprint, **self.indices)
+
+    def order(self):
+        return np.concatenate([self.indices[name] for name in self.NAMES])
+
+    def bounds(self):
+        bounds, start = {}, 0
+        for name in self.NAMES:
+            bounds[name] = (start, start + len(self.indices[name]))
+            start = bounds[name][1]
+        return bounds
+
+    def arrange(self, *tensors):
+        """Reorder the tensors once and return a dict of views for every split."""
+        order = torch.from_numpy(self.order())
+        arranged = [t[order] for t in tensors] # the only copy we make
+        return {name: tuple(t[a:b] for t in arranged) for name, (a, b) in self.bounds().items()}
+
+"""Labels are one_hot, so `argmax` gives us the class of every sample for the stratified split. We keep the 10% for testing as before (here it's called `val`)."""
+
+def split_data(x, y, paths=None):
+    val_size = int(len(x)*VAL_PCT)
+    print(val_size)
+    splits = DataSplits.load_or_create("splits.npz", len(x), val_pct=VAL_PCT, seed=42,
+                                       labels=torch.argmax(y, dim=1).numpy(), keys=paths)
+    views = splits.arrange(x, y)
+
+    train_x, train_y = views["train"]
+    test_x, test_y = views["val"]
+
+    print(len(train_x))
+    print(len(test_x))
+    return train_x, train_y, test_x, test_y, splits
 
 """## Note
 The quickest way to deal with the memory errors is to lower the batch size. If you cannot run more than 8 in a batch, you need to downsize the model itself (like reducing the number of layers).
@@ -252,19 +373,21 @@ Since we have previously used `optim.Adam(net.parameters(), lr=0.001)`, all our
 BATCH_SIZE = 100
 EPOCHS = 3
 
-for epoch in range(EPOCHS):
-    for i in tqdm(range(0, len(train_x), BATCH_SIZE)):
-        #print(i, i+BATCH_SIZE) 
-        batch_x = train_x[i:i+BATCH_SIZE].view(-1,1,50,50)
-        batch_y = train_y[i:i+BATCH_SIZE]
-
-        net.zero_grad()
-        outputs = net(batch_x) 
-        loss = loss_function(outputs, batch_y)
-        loss.backward()
-        optimizer.step()
-    
-print(loss)
+def train(net, optimizer, loss_function, train_x, train_y):
+    from tqdm import tqdm
+    for epoch in range(EPOCHS):
+        for i in tqdm(range(0, len(train_x), BATCH_SIZE)):
+            #print(i, i+BATCH_SIZE) 
+            batch_x = train_x[i:i+BATCH_SIZE].view(-1,1,50,50)
+            batch_y = train_y[i:i+BATCH_SIZE]
+
+            net.zero_grad()
+            outputs = net(batch_x) 
+            loss = loss_function(outputs, batch_y)
+            loss.backward()
+            optimizer.step()
+        
+    print(loss)
 
 """## Evaluating the model
 
@@ -273,14 +396,53 @@ Increasing the number of epochs will help with the accuracy.
 
 """
 
-correct = 0
-total = 0
-with torch.no_grad():
-    for i in  tqdm(range(len(test_x))):
-        real_class = torch.argmax(test_y[i])
-        net_out = net(test_x[i].view(-1,1,50,50))[0] #the zeroeth element
-        predicted_class = torch.argmax(net_out)
-        if predicted_class == real_class:
-            correct +=1
-        total +=1
-print("Accuracy: ", round(correct/total,3))
\ No newline at end of file
+def test(net, test_x, test_y, errors=None, test_ids=None, epoch=0):
+    from tqdm import tqdm
+    correct = 0
+    total = 0
+    outputs = []
+    with torch.no_grad():
+        for i in  tqdm(range(len(test_x))):
+            real_class = torch.argmax(test_y[i])
+            net_out = net(test_x[i].view(-1,1,50,50))[0] #the zeroeth element
+            outputs.append(net_out)
+            predicted_class = torch.argmax(net_out)
+            if predicted_class == real_class:
+                correct +=1
+            total +=1
+    print("Accuracy: ", round(correct/total,3))
+    if errors is not None:
+        # the net gives probabilities and we trained with the MSE, so that's the loss of every sample too
+        outputs = torch.stack(outputs)
+        confidence, preds = outputs.max(dim=1)
+        loss = ((outputs - test_y)**2).mean(dim=1)
+        errors.record(epoch, test_ids, torch.argmax(test_y, dim=1), preds, confidence, loss)
+        errors.commit(epoch)
+
+"""## Which images are wrong?
+With 25k images we can't look at them all to find the bad ones (there are some drawings, some images with a dog and a cat, and some that are in the wrong folder). With `ErrorIndex` (in `trainingtools.py`, the TransferLearning tutorial uses it too; in Colab upload it next to the notebook) `test` saves one row per test image (index in `training_data.npy`, label, prediction, confidence and loss) and `training_paths.npy` gives us the file of every index. Then finding the wrong labels is a query: `always_wrong(0.9)` lists the images the network is very sure about and still gets wrong, `hardest(k)` the images with the highest loss.
+"""
+
+import sys
+# trainingtools.py is in the root of the repo. A notebook has no __file__, there it has to be next to the notebook
+here = os.path.dirname(os.path.abspath(__file__)) if "__file__" in globals() else os.getcwd()
+sys.path += [here, os.path.join(here, os.pardir)]
+from trainingtools import ErrorIndex
+
+def main():
+    training_data = load_training_data()
+    x, y = to_tensors(training_data)
+    paths = np.load("training_paths.npy") if os.path.exists("training_paths.npy") else None
+    if paths is not None and len(paths) != len(x):
+        paths = None # from an older training_data.npy
+    train_x, train_y, test_x, test_y, splits = split_data(x, y, paths)
+    net = Net()
+    optimizer, loss_function = get_optimizer(net)
+    train(net, optimizer, loss_function, train_x, train_y)
+    errors = ErrorIndex("petimages_errors", paths=paths, class_names=["cat", "dog"])
+    test(net, test_x, test_y, errors, test_ids=splits.indices["val"]) # test_x is in the order of the val indices
+    for row in errors.always_wrong(min_confidence=0.9)[:20]:
+        print(row)
+
+if __name__ == "__main__":
+    main()
@@ -11,24 +11,27 @@ We'll be training the neural network built previously by learning how to iterate
 """
 
 import torch
-import torchvision
-from torchvision import transforms, datasets
 import torch.nn as nn
 import torch.nn.functional as F
 
-train = datasets.MNIST('', train=True, download=True,
-                       transform=transforms.Compose([
-                           transforms.ToTensor()
-                       ]))
+"""Other scripts import this file for `Net`, so nothing is downloaded or trained when it is imported. torchvision is imported inside `load_mnist` since it takes a while, and everything else runs from `main()` at the end."""
 
-test = datasets.MNIST('', train=False, download=True,
-                       transform=transforms.Compose([
-                           transforms.ToTensor()
-                       ]))
+def load_mnist(root='', batch_size=10):
+    from torchvision import transforms, datasets
+    train = datasets.MNIST(root, train=True, download=True,
+                           transform=transforms.Compose([
+                               transforms.ToTensor()
+                           ]))
 
+    test = datasets.MNIST(root, train=False, download=True,
+                           transform=transforms.Compose([
+                               transforms.ToTensor()
+                           ]))
 
-trainset = torch.utils.data.DataLoader(train, batch_size=10, shuffle=True)
-testset = torch.utils.data.DataLoader(test, batch_size=10, shuffle=False)
+
+    trainset = torch.utils.data.DataLoader(train, batch_size=batch_size, shuffle=True)
+    testset = torch.utils.data.DataLoader(test, batch_size=batch_size, shuffle=False)
+    return trainset, testset
 
 
 class Net(nn.Module):
@@ -46,9 +49,6 @@ class Net(nn.Module):
         x = self.fc4(x)
         return F.log_softmax(x, dim=1)
 
-net = Net()
-print(net)
-
 """## Loss and Optimizer
 ### Loss 
 It is a measurement of how far off the neural network is from the targeted output. The degree to which you're wrong doesn't matter in terms of the choice necessarily, but in terms of you learning, it does. The goal over time is to have loss decrease.
@@ -82,8 +82,11 @@ Implements Adam algorithm (Adaptive Momentum).
 """
 
 import torch.optim as optim
-loss_function= nn.CrossEntropyLoss()
-optimizer = optim.Adam(net.parameters(), lr=0.001)
+
+def get_optimizer(net):
+    loss_function= nn.CrossEntropyLoss()
+    optimizer = optim.Adam(net.parameters(), lr=0.001)
+    return loss_function, optimizer
 
 """## Iterating over the data
 
@@ -116,19 +119,32 @@ Everything is still running on the CPU and that is why they are slow. We will mo
 
 """
 
-Epochs=3
-for epoch in range(Epochs):
-  for data in trainset:
-    X, y= data # Grab the features (X) and labels (y) from current batch
-    #print(X[0])
-    #print(y[0])
-    #break
-    net.zero_grad() # Zero the gradients
-    output= net(X.view(-1, 28*28)) # pass in the reshaped batch through the network
-    loss=F.nll_loss(output, y) # calc and grab the loss value
-    loss.backward() # apply this loss backwards thru the network's parameters
-    optimizer.step() # attempt to optimize weights to account for loss/gradients
-  print(loss) # print loss. We hope loss (a measure of wrong-ness) declines!
+"""## Prefetching the batches
+This is the `DevicePrefetcher` of the TransferLearning tutorial, from `trainingtools.py` in the root of the repo (in Colab, upload `trainingtools.py` next to the notebook). It gives us the batches already on `device`: on a GPU the next batch is copied (from pinned memory, on a separate stream) while the current one is trained on, and on the CPU a background thread loads the next batches. The loops below work the same on both.
+"""
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+import os
+import sys
+# trainingtools.py is in the root of the repo. A notebook has no __file__, there it has to be next to the notebook
+here = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path += [here, os.path.join(here, os.pardir)]
+from trainingtools import DevicePrefetcher
+
+def train(net, trainset, optimizer, Epochs=3):
+    for epoch in range(Epochs):
+        for data in DevicePrefetcher(trainset, device):
+            X, y= data # Grab the features (X) and labels (y) from current batch
+            #print(X[0])
+            #print(y[0])
+            #break
+            net.zero_grad() # Zero the gradients
+            output= net(X.view(-1, 28*28)) # pass in the reshaped batch through the network
+            loss=F.nll_loss(output, y) # calc and grab the loss value
+            loss.backward() # apply this loss backwards thru the network's parameters
+            optimizer.step() # attempt to optimize weights to account for loss/gradients
+        print(loss) # print loss. We hope loss (a measure of wrong-ness) declines!
 
 """## Accuracy
 
@@ -146,31 +162,59 @@ We are comparing every prediction made with the actual target value and if it is
 Be carefull because it is very easy to mess the neural network with some bias that you are adding without realising. The accuracy might get very high but not a good way!
 """
 
-correct = 0
-total = 0
-
-with torch.no_grad():
-  #Batch of information
-  for data in testset:
-    X, y= data
-    output = net(X.view(-1, 784))
-    #Comparing
-    for idx, i in enumerate(output):
-      if torch.argmax(i)== y[idx]:
-        correct +=1
-      total +=1
-print("Accuracy: ", round(correct/total, 3))
+def test(net, testset, errors=None, epoch=0):
+    correct = 0
+    total = 0
+
+    with torch.no_grad():
+        #Batch of information
+        for data in DevicePrefetcher(testset, device):
+            X, y= data
+            output = net(X.view(-1, 784))
+            if errors is not None:
+                # testset is not shuffled, so the position is the index of the image in the test set
+                errors.record_logits(epoch, range(total, total + len(y)), y, output)
+            #Comparing
+            for idx, i in enumerate(output):
+                if torch.argmax(i)== y[idx]:
+                    correct +=1
+                total +=1
+    print("Accuracy: ", round(correct/total, 3))
+    if errors is not None:
+        errors.commit(epoch)
+    return X # the last batch, for the plot below
+
+"""## Which images are wrong?
+The accuracy doesn't tell us which digits the network gets wrong. `ErrorIndex` (in `trainingtools.py`, the TransferLearning tutorial uses it too) lets `test` save one row per test image (index, label, prediction, confidence and loss) to a small file, and then we can ask for the hardest images, the digits that get confused the most, or the images that changed between two runs without testing again. MNIST has no files, so there are no paths, just the index in the test set.
+"""
+
+from trainingtools import ErrorIndex
 
 """## Plotting
 
 Change the elements of X and see it for different result.
 """
 
-import matplotlib.pyplot as plt
+def show_prediction(net, X):
+    import matplotlib.pyplot as plt
+
+    plt.imshow(X[1].cpu().view(28,28)) #getting it back to the image form
+    plt.show()
+
+    # Since we are inputting a list we will get a list back and we need to say the zeroeth element.
 
-plt.imshow(X[1].view(28,28)) #getting it back to the image form
-plt.show()
+    print(torch.argmax(net(X[1].view(-1,784))[0]))
 
-"""Since we are inputting a list we will get a list back and we need to say the zeroeth element."""
+def main():
+    trainset, testset = load_mnist()
+    net = Net().to(device)
+    print(net)
+    loss_function, optimizer = get_optimizer(net)
+    train(net, trainset, optimizer)
+    errors = ErrorIndex('mnist_errors', class_names=range(10))
+    X = test(net, testset, errors)
+    print('Most confused digits (label, predicted, count):', errors.confusion_pairs(k=5))
+    show_prediction(net, X)
 
-print(torch.argmax(net(X[1].view(-1,784))[0]))
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -58,11 +58,402 @@ class Tree:
     cv.rectangle(bg,(WIDTH,ground_level),(0, HEIGHT), (70,180,75), -1)
     return self.img
 
-# display image
-from google.colab.patches import cv2_imshow
-for i in range(n_trees):
-  img = Tree(bg).draw()
-cv2_imshow(img)
-
-cv.waitKey(0)
-cv.destroyAllWindows()
\ No newline at end of file
+"""## Batched rendering
+`Tree.draw` makes a dozen OpenCV calls for every tree and fills the ground again each time, so the cost grows quickly with the number of trees. Here we do it the other way around:
+
+- The geometry of all the trees is computed at once with NumPy arrays. Every shape of a tree is a *capsule*, a segment with a radius: a trunk or a branch is a thick line and a leaf is a segment of length 0, i.e. a filled circle.
+- The sky and the ground are drawn only once and cached in `SceneRenderer`.
+- The rounding to pixels is done for all shapes at once in `draw_calls`, so drawing is just one `cv.line` or `cv.circle` per shape, in the same order as `Tree.draw`, on a copy of the cached background. No random colours per call and no ground rectangle per tree.
+
+`benchmark` compares it with `Tree.draw` (`python oop_practice.py --bench`).
+"""
+
+def tree_shapes(loc, ht, scale, green, light_green, brown):
+  """Capsules (x0, y0, x1, y1, radius, colour) of all trees, in the order Tree.draw paints them."""
+  loc = np.asarray(loc, dtype=np.float32)
+  top = ground_level - np.asarray(ht, dtype=np.float32)
+  scale = np.asarray(scale, dtype=np.float32).reshape(-1)
+  small_radius = np.trunc(30*scale)
+  branch_y = top + 75*scale
+  side_y = top + small_radius
+  left, right = loc - 45*scale, loc + 45*scale
+  left_leaf = loc - np.trunc(45*scale) # Tree.draw rounds this one differently from the branch and the highlight
+  ground = np.full_like(loc, ground_level)
+  # one column per shape: trunk, 2 branches, 3 leaves, 3 leaf highlights
+  x0 = np.stack([loc, loc, loc, loc, left_leaf, right, loc, left, right], axis=1)
+  y0 = np.stack([ground, branch_y, branch_y, top, side_y, side_y, top, side_y, side_y], axis=1)
+  x1 = np.stack([loc, right, left, loc, left_leaf, right, loc, left, right], axis=1)
+  y1 = np.stack([top, side_y, side_y, top, side_y, side_y, top, side_y, side_y], axis=1)
+  radius = np.stack([np.trunc(20*scale)/2, np.trunc(5*scale)/2, np.trunc(5*scale)/2,
+                     np.trunc(50*scale), small_radius, small_radius,
+                     np.trunc(40*scale), small_radius-10*scale, small_radius-10*scale], axis=1)
+  colour_of = np.array([2, 2, 2, 0, 0, 0, 1, 1, 1]) # 0: green, 1: light green, 2: brown
+  colours = np.stack([green, light_green, brown], axis=1).astype(np.uint8)[:, colour_of]
+  return (x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel(),
+          np.maximum(radius, 0.5).ravel(), colours.reshape(-1, 3))
+
+def shapes_from_trees(trees):
+  colours = [tree.generate_colours() for tree in trees]
+  green, light_green, brown = (np.array(c) for c in zip(*colours))
+  return tree_shapes([tree.loc for tree in trees], [tree.ht for tree in trees],
+                     [float(tree.scale[0]) for tree in trees], green, light_green, brown)
+
+def draw_calls(x0, y0, x1, y1, radius, colours):
+  """The capsules as integer OpenCV calls: (x0, y0, x1, y1, size, colour), a circle when the segment is a point."""
+  # all the rounding is done here once with NumPy, drawing is then only cv.line/cv.circle
+  x0, y0, x1, y1 = (np.trunc(v).astype(np.int32).tolist() for v in (x0, y0, x1, y1))
+  circle = (np.asarray(x0) == np.asarray(x1)) & (np.asarray(y0) == np.asarray(y1))
+  size = np.where(circle, np.trunc(radius), np.maximum(np.trunc(2*radius), 1)).astype(np.int32)
+  size = np.where(circle, size, -size).tolist() # negative size: a line of that thickness
+  colours = [tuple(c) for c in np.asarray(colours, dtype=np.uint8).tolist()]
+  return list(zip(x0, y0, x1, y1, size, colours))
+
+def draw(img, calls, dx=0, dy=0):
+  """Paint the calls into img in order (later ones on top), shifted by (-dx, -dy)."""
+  for x0, y0, x1, y1, size, colour in calls:
+    if size >= 0:
+      cv.circle(img, (x0 - dx, y0 - dy), size, colour, -1) # -1 makes it fill the circle
+    else:
+      cv.line(img, (x0 - dx, y0 - dy), (x1 - dx, y1 - dy), colour, -size)
+  return img
+
+class SceneRenderer:
+  def __init__(self, width=WIDTH, height=HEIGHT, ground=ground_level):
+    self.ground = ground
+    # sky and ground are drawn only once
+    self.background = np.zeros((height, width, 3), dtype=np.uint8)
+    cv.rectangle(self.background, (width, 0), (0, ground), (255,225,95), -1)
+    cv.rectangle(self.background, (width, ground), (0, height), (70,180,75), -1)
+
+  def render(self, shapes):
+    img = draw(self.background.copy(), draw_calls(*shapes))
+    img[self.ground:] = self.background[self.ground:] # the ground covers the bottom of the trunks
+    return img
+
+"""## A forest of arrays
+Every `Tree` is a whole Python object and `np.random.choice(range(900),1)` builds a new range for every attribute of every tree. For a lot of trees it is better to keep one array per attribute (columns) in a `Forest`:
+
+- All the random numbers come from a single `rng.integers` call. `low` and `high` are given per column, so one call draws the location, height, scale, colours, ... of all trees.
+- With a `seed` you get the same forest every time.
+- `forest[i]` gives a `TreeView`, a tiny object that only knows its forest and its index. `__slots__` means it has no `__dict__`, so it's cheap to create.
+"""
+
+class Forest:
+  SCALES = np.linspace(0.5, 2.5, num=8)
+  BROWNS = np.array([(2,30,85), (5,55,120), (0,30,100)], dtype=np.uint8)
+  radius = 50
+
+  def __init__(self, n, seed=None):
+    rng = np.random.default_rng(seed)
+    # columns: loc, ht, scale index, green, light green, brown index
+    params = rng.integers([0, 200, 0, 130, 200, 0], [WIDTH, 350, len(self.SCALES), 201, 251, len(self.BROWNS)], size=(n, 6))
+    self.loc = params[:, 0]
+    self.ht = params[:, 1]
+    self.scale = self.SCALES[params[:, 2]]
+    self.green = np.zeros((n, 3), dtype=np.uint8)
+    self.green[:, 1] = params[:, 3]
+    self.light_green = np.full((n, 3), 35, dtype=np.uint8)
+    self.light_green[:, 1] = params[:, 4]
+    self.brown = self.BROWNS[params[:, 5]]
+
+  def __len__(self):
+    return len(self.loc)
+
+  def __getitem__(self, i):
+    if not -len(self) <= i < len(self):
+      raise IndexError("tree index out of range")
+    return TreeView(self, i % len(self))
+
+  def __iter__(self):
+    return (TreeView(self, i) for i in range(len(self)))
+
+  def shapes(self):
+    return tree_shapes(self.loc, self.ht, self.scale, self.green, self.light_green, self.brown)
+
+class TreeView:
+  __slots__ = ("forest", "index")
+
+  def __init__(self, forest, index):
+    self.forest = forest
+    self.index = index
+
+  @property
+  def loc(self):
+    return int(self.forest.loc[self.index])
+
+  @property
+  def ht(self):
+    return int(self.forest.ht[self.index])
+
+  @property
+  def scale(self):
+    return float(self.forest.scale[self.index])
+
+  @property
+  def radius(self):
+    return self.forest.radius
+
+  def generate_colours(self):
+    f, i = self.forest, self.index
+    return tuple(int(c) for c in f.green[i]), tuple(int(c) for c in f.light_green[i]), tuple(int(c) for c in f.brown[i])
+
+  def __repr__(self):
+    return f"TreeView(loc={self.loc}, ht={self.ht}, scale={self.scale:.2f})"
+
+"""## Generating scenes in batch
+We also use these scenes as synthetic training data, so we need a lot of them and no Colab display. `generate_scenes` renders `n_scenes` independent forests on a pool of processes:
+
+- Every scene gets its own seed from `np.random.SeedSequence(seed).spawn(n_scenes)`, so the batch is reproducible and the scenes don't depend on which worker renders them.
+- The workers write the frames straight into one shared array, either a `multiprocessing.shared_memory` block or, when `memmap_path` is given, a `.npy` file opened with `np.lib.format.open_memmap` (for batches that don't fit in RAM). Nothing is pickled back to the parent except the scene numbers.
+- If `out_dir` is given, every worker encodes its own frames to PNG. Then the frames are not kept in memory at all and `generate_scenes` returns `None` (unless `memmap_path` is given too, then you get the memmap back). Only without both the frames are copied out of the shared block and returned, so keep those batches small.
+"""
+
+import os
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+def _open_frames(target, shape):
+  if target is None: # only PNG files, one frame buffer is enough
+    return None, None
+  kind, where = target
+  if kind == "memmap":
+    return None, np.lib.format.open_memmap(where, mode="r+")
+  shm = shared_memory.SharedMemory(name=where)
+  return shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+def _render_scenes(job):
+  target, shape, start, seeds, trees_per_scene, out_dir = job
+  shm, frames = _open_frames(target, shape)
+  renderer = SceneRenderer(width=shape[2], height=shape[1])
+  for k, seed in enumerate(seeds):
+    frame = renderer.render(Forest(trees_per_scene, seed=seed).shapes())
+    if frames is not None:
+      frames[start + k] = frame
+    if out_dir is not None:
+      cv.imwrite(os.path.join(out_dir, f"scene_{start + k:06d}.png"), frame)
+  if shm is not None:
+    shm.close()
+  return len(seeds)
+
+def generate_scenes(n_scenes, trees_per_scene=n_trees, seed=0, out_dir=None, memmap_path=None,
+                    processes=None, chunksize=8):
+  shape = (n_scenes, HEIGHT, WIDTH, 3)
+  shm = None
+  frames = None
+  if memmap_path is not None:
+    frames = np.lib.format.open_memmap(memmap_path, mode="w+", dtype=np.uint8, shape=shape)
+    frames.flush()
+    target = ("memmap", memmap_path)
+  elif out_dir is not None:
+    target = None # the frames are on disk, we don't keep them
+  else:
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    target = ("shm", shm.name)
+  if out_dir is not None:
+    os.makedirs(out_dir, exist_ok=True)
+  seeds = np.random.SeedSequence(seed).spawn(n_scenes)
+  jobs = [(target, shape, i, seeds[i:i + chunksize], trees_per_scene, out_dir)
+          for i in range(0, n_scenes, chunksize)]
+  try:
+    with mp.Pool(processes) as pool:
+      for _ in pool.imap_unordered(_render_scenes, jobs):
+        pass
+    if shm is not None:
+      # the only case where the frames are copied: the shared block goes away when we return
+      frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+    elif memmap_path is not None:
+      frames = np.load(memmap_path, mmap_mode="r")
+  finally:
+    if shm is not None:
+      shm.close()
+      shm.unlink()
+  return frames
+
+"""## Redrawing only what changed
+For an animation most of the frame stays the same between two steps. `IncrementalScene` keeps the last frame and splits it into a grid of tiles (`tile` pixels each):
+
+- Every tree knows its bounding box and every tile knows which trees touch it.
+- `add`, `move`, `recolour` and `remove` only mark the tiles under the old and the new bounding box as *dirty*.
+- `update()` redraws the dirty tiles: it puts the cached background of the rectangle around them into a full-size scratch image, paints only the trees that touch a dirty tile (each of them once, in their original order, so overlaps look the same, and at their real place, because OpenCV draws a thick line that it has to cut at the border of an image a little differently), puts the ground back and copies the dirty tiles into the frame.
+
+So a step costs time proportional to what changed, not to the number of trees.
+"""
+
+from collections import defaultdict
+
+class IncrementalScene:
+  def __init__(self, forest=None, tile=64, renderer=None):
+    self.renderer = renderer if renderer is not None else SceneRenderer()
+    self.frame = self.renderer.background.copy()
+    self.scratch = self.renderer.background.copy() # the trees are redrawn here, then the dirty tiles are copied
+    self.tile = tile
+    self.params = {} # tree id -> (loc, ht, scale, green, light_green, brown)
+    self.calls = {}  # tree id -> OpenCV calls of the tree
+    self.boxes = {}  # tree id -> tiles covered by the tree
+    self.tiles = defaultdict(set) # (row, col) -> tree ids
+    self.dirty = set()
+    self._next_id = 0
+    if forest is not None:
+      for tree in forest:
+        self.add(tree.loc, tree.ht, tree.scale, *tree.generate_colours())
+
+  def _tiles_of(self, shapes):
+    x0, y0, x1, y1, radius, _ = shapes
+    h, w = self.frame.shape[:2]
+    left = max(int(np.floor(np.min(np.minimum(x0, x1) - radius))), 0) // self.tile
+    right = min(int(np.ceil(np.max(np.maximum(x0, x1) + radius))), w - 1) // self.tile
+    top = max(int(np.floor(np.min(np.minimum(y0, y1) - radius))), 0) // self.tile
+    bottom = min(int(np.ceil(np.max(np.maximum(y0, y1) + radius))), h - 1) // self.tile
+    return {(r, c) for r in range(top, bottom + 1) for c in range(left, right + 1)}
+
+  def _place(self, tree_id, params):
+    self._unplace(tree_id)
+    loc, ht, scale, green, light_green, brown = params
+    shapes = tree_shapes([loc], [ht], [scale], [green], [light_green], [brown])
+    self.params[tree_id] = params
+    self.calls[tree_id] = draw_calls(*shapes)
+    self.boxes[tree_id] = self._tiles_of(shapes)
+    for key in self.boxes[tree_id]:
+      self.tiles[key].add(tree_id)
+    self.dirty |= self.boxes[tree_id]
+
+  def _unplace(self, tree_id):
+    for key in self.boxes.pop(tree_id, ()):
+      self.tiles[key].discard(tree_id)
+      self.dirty.add(key)
+    self.calls.pop(tree_id, None)
+
+  def add(self, loc, ht, scale, green, light_green, brown):
+    tree_id = self._next_id
+    self._next_id += 1
+    self._place(tree_id, (loc, ht, scale, green, light_green, brown))
+    return tree_id
+
+  def move(self, tree_id, loc=None, ht=None):
+    old_loc, old_ht, *rest = self.params[tree_id]
+    self._place(tree_id, (old_loc if loc is None else loc, old_ht if ht is None else ht, *rest))
+
+  def recolour(self, tree_id, green=None, light_green=None, brown=None):
+    loc, ht, scale, *colours = self.params[tree_id]
+    # the colours that are not given stay as they are
+    new = [old if colour is None else colour for old, colour in zip(colours, (green, light_green, brown))]
+    self._place(tree_id, (loc, ht, scale, *new))
+
+  def remove(self, tree_id):
+    self._unplace(tree_id)
+    del self.params[tree_id]
+
+  def update(self):
+    """Redraw the dirty tiles and return the updated frame."""
+    if not self.dirty:
+      return self.frame
+    h, w = self.frame.shape[:2]
+    # the background of the rectangle around the dirty tiles, and every tree touching them is drawn once over it
+    rows = [r for r, _ in self.dirty]
+    cols = [c for _, c in self.dirty]
+    y0, x0 = min(rows)*self.tile, min(cols)*self.tile
+    y1, x1 = min((max(rows) + 1)*self.tile, h), min((max(cols) + 1)*self.tile, w)
+    buf = self.scratch
+    buf[y0:y1, x0:x1] = self.renderer.background[y0:y1, x0:x1]
+    ids = sorted(set().union(*(self.tiles.get(key, ()) for key in self.dirty)))
+    for tree_id in ids: # in the original order, so overlaps look the same
+      # at their place in a full-size image: OpenCV cuts a thick line at the border of the
+      # image, which changes its pixels, so in a smaller buffer it would not look like a full render
+      draw(buf, self.calls[tree_id])
+    ground = self.renderer.ground
+    if ground < y1:
+      g = max(ground, y0)
+      buf[g:y1, x0:x1] = self.renderer.background[g:y1, x0:x1]
+    # only the dirty tiles are copied: the others may have trees we didn't draw
+    for row, col in self.dirty:
+      ty, tx = row*self.tile, col*self.tile
+      self.frame[ty:ty + self.tile, tx:tx + self.tile] = buf[ty:ty + self.tile, tx:tx + self.tile]
+    self.dirty.clear()
+    return self.frame
+
+"""## How fast is it?
+`benchmark` draws the same trees with `Tree.draw` and with `SceneRenderer` (`shapes_from_trees` turns the `Tree` objects into capsules, with the same random colours), checks that both give the same pixels above the ground, and times one `move` + `update` of an `IncrementalScene`. The times are the best of `repeat` runs, in milliseconds.
+"""
+
+import time
+import warnings
+
+def _best_ms(fn, repeat):
+  best = float("inf")
+  for _ in range(repeat):
+    since = time.perf_counter()
+    fn()
+    best = min(best, time.perf_counter() - since)
+  return best*1000
+
+def benchmark(sizes=(30, 1000, 3000), repeat=5, seed=0):
+  renderer = SceneRenderer()
+  results = []
+  for n in sizes:
+    np.random.seed(seed)
+    img = bg.copy()
+    with warnings.catch_warnings(): # Tree uses int() on 1-element arrays
+      warnings.simplefilter("ignore", DeprecationWarning)
+      trees = [Tree(img) for _ in range(n)]
+    def baseline():
+      with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        for tree in trees:
+          tree.draw()
+    # both take the colours from `random`, so with the same seed they draw the same trees
+    random.seed(seed)
+    baseline()
+    random.seed(seed)
+    shapes = shapes_from_trees(trees)
+    # below the ground they differ: Tree.draw paints the ground on bg instead of on its image
+    same = np.array_equal(img[:ground_level], renderer.render(shapes)[:ground_level])
+    forest = Forest(n, seed=seed)
+    scene = IncrementalScene(forest)
+    scene.update()
+    def step():
+      tree_id = random.randrange(n)
+      scene.move(tree_id, loc=random.randrange(WIDTH))
+      scene.update()
+    row = {"trees": n, "Tree.draw": _best_ms(baseline, repeat), "render": _best_ms(lambda: renderer.render(shapes), repeat),
+           "move+update": _best_ms(step, repeat), "same": same}
+    results.append(row)
+    print(f"{n:6d} trees: Tree.draw {row['Tree.draw']:8.1f}ms  render {row['render']:8.1f}ms  "
+          f"move+update {row['move+update']:6.1f}ms  {'same pixels' if same else 'DIFFERENT pixels'}")
+  return results
+
+"""## Display
+In Colab we show the image with `cv2_imshow`. Outside of Colab (e.g. on a server) there is no display, so we just save it. Run the file with `--batch N` to generate N scenes into `--out` instead.
+"""
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description="Draw a forest scene, or a batch of them.")
+  parser.add_argument("--batch", type=int, default=0, help="number of scenes to generate")
+  parser.add_argument("--out", default="scenes", help="directory for the PNG files")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--processes", type=int, default=None)
+  parser.add_argument("--memmap", default=None, help="keep the frames in this .npy file instead of RAM")
+  parser.add_argument("--bench", action="store_true", help="compare the renderer with Tree.draw")
+  args, _ = parser.parse_known_args()
+
+  if args.bench:
+    benchmark()
+  elif args.batch:
+    since = time.time()
+    generate_scenes(args.batch, seed=args.seed, out_dir=args.out, memmap_path=args.memmap,
+                    processes=args.processes)
+    elapsed = time.time() - since
+    print(f"{args.batch} scenes in {elapsed:.1f}s ({args.batch / elapsed * 60:.0f} scenes/min)")
+  else:
+    # display image
+    forest = Forest(n_trees, seed=args.seed)
+    img = SceneRenderer().render(forest.shapes())
+    try:
+      from google.colab.patches import cv2_imshow
+    except ImportError:
+      cv.imwrite("forest.png", img)
+    else:
+      cv2_imshow(img)
+
+      cv.waitKey(0)
+      cv.destroyAllWindows()
\ No newline at end of file
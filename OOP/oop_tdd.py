@@ -15,14 +15,296 @@ Encryption Algorithm
 - Cesar's Cipher: Takes the alphabet and shift them one character to the right
 """
 
+import io
+import os
+import tempfile
 import unittest
 import string
 
+ABC = string.ascii_letters + string.punctuation + string.digits + " "
+
+"""### Translation table
+`abc.find(char)` looks through the whole alphabet for every character. Since the mapping never changes, we can build it once as a table and let `str.translate` do the work for the whole message.
+
+- Every character of the alphabet is moved `shift` places to the right and the end wraps around to the beginning (for `shift=1` the last character, `" "`, becomes `abc[0]`, like before).
+- Characters that are not in the alphabet are treated like `find` does, as index -1, so with `shift=1` they become `abc[0]`. `_Table.__missing__` handles them and remembers the answer.
+- `decrypt` uses the reverse table. It can't bring back characters that were not in the alphabet.
+"""
+
+class _Table(dict):
+  def __init__(self, mapping, default=None):
+    super().__init__(mapping)
+    self.default = default
+
+  def __missing__(self, key):
+    if self.default is None:
+      raise LookupError(key) # str.translate leaves the character as it is
+    self[key] = self.default
+    return self.default
+
+class Cipher:
+  def __init__(self, shift=1, alphabet=ABC):
+    if len(set(alphabet)) != len(alphabet):
+      raise ValueError("alphabet must not contain duplicate characters")
+    self.shift = shift
+    self.alphabet = alphabet
+    shifted = alphabet[shift % len(alphabet):] + alphabet[:shift % len(alphabet)]
+    self._encrypt_table = _Table(str.maketrans(alphabet, shifted), ord(alphabet[(shift - 1) % len(alphabet)]))
+    self._decrypt_table = _Table(str.maketrans(shifted, alphabet))
+
+    self._bytes_tables = None
+
+  def encrypt(self, message):
+    return message.translate(self._encrypt_table)
+
+  def decrypt(self, message):
+    return message.translate(self._decrypt_table)
+
+  def bytes_tables(self):
+    """256-entry tables for bytes.translate, only for ASCII alphabets."""
+    if self._bytes_tables is None:
+      if not self.alphabet.isascii():
+        raise ValueError("the bytes mode needs an ASCII alphabet")
+      encrypt_table = bytearray([self._encrypt_table.default]) * 256 # every other byte is unknown
+      decrypt_table = bytearray(range(256))
+      for cipher, plain in self._decrypt_table.items():
+        encrypt_table[plain] = cipher
+        decrypt_table[cipher] = plain
+      self._bytes_tables = bytes(encrypt_table), bytes(decrypt_table)
+    return self._bytes_tables
+
+  def translate(self, chunk, decrypt=False):
+    """Encrypt (or decrypt) a str, or bytes with the ASCII fast path."""
+    if isinstance(chunk, str):
+      return self.decrypt(chunk) if decrypt else self.encrypt(chunk)
+    return bytes(chunk).translate(self.bytes_tables()[decrypt])
+
+  def stream(self, chunks, decrypt=False):
+    """Encrypt an iterable of chunks one at a time, so only one chunk is in memory."""
+    for chunk in chunks:
+      yield self.translate(chunk, decrypt)
+
+  def translate_file(self, src, dst, decrypt=False, chunk_size=1 << 22):
+    """Copy the file-like object src to dst, encrypted. Returns the number of characters (or bytes)."""
+    total = 0
+    for chunk in self.stream(iter(lambda: src.read(chunk_size), src.read(0)), decrypt):
+      dst.write(chunk)
+      total += len(chunk)
+    return total
+
+_cipher = Cipher()
+
 def encrypt(message):
-  abc = string.ascii_letters + string.punctuation + string.digits + " "
-  encrypted_message = "".join([abc[abc.find(char) + 1] if len(abc)> (abc.find(char)+1) else abc[0] for idx, char in enumerate(message)])
-  print(encrypted_message)
-  return encrypted_message
+  return _cipher.encrypt(message)
+
+def decrypt(message):
+  return _cipher.decrypt(message)
+
+"""### Streaming
+Log files can be much bigger than the memory, but every character is encrypted on its own, so we can simply read the file in chunks:
+
+- `Cipher.stream(chunks)` takes any iterable of `str` or `bytes` chunks.
+- For `bytes` it uses `bytes.translate` with a 256-entry table, so the data never has to be decoded. Every byte outside of the alphabet counts as an unknown character, i.e. a non-ASCII character in UTF-8 becomes several `abc[0]`. Use `--encoding` if you want the text behaviour instead.
+- From the command line: `python oop_tdd.py encrypt big.log big.log.enc` (or `decrypt`, `-` for stdin/stdout).
+"""
+
+import sys
+import argparse
+
+def _open(path, mode, encoding):
+  if path == "-":
+    stream = sys.stdin if "r" in mode else sys.stdout
+    if not encoding:
+      return stream.buffer
+    stream.reconfigure(encoding=encoding, newline="") # the same text mode as a file
+    return stream
+  if encoding:
+    return open(path, mode, encoding=encoding, newline="")
+  return open(path, mode + "b")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Caesar cipher for big files.")
+  parser.add_argument("mode", choices=["encrypt", "decrypt"])
+  parser.add_argument("src", help="input file, - for stdin")
+  parser.add_argument("dst", help="output file, - for stdout")
+  parser.add_argument("--shift", type=int, default=1)
+  parser.add_argument("--encoding", default=None, help="read the file as text instead of bytes")
+  parser.add_argument("--chunk-size", type=int, default=1 << 22)
+  parser.add_argument("--processes", type=int, default=None, help="encrypt on this many processes")
+  args = parser.parse_args(argv)
+
+  cipher = Cipher(args.shift)
+  src = _open(args.src, "r", args.encoding)
+  dst = _open(args.dst, "w", args.encoding)
+  try:
+    if args.processes:
+      stats = parallel_translate_file(cipher, src, dst, decrypt=args.mode == "decrypt",
+                                      processes=args.processes, chunk_size=args.chunk_size)
+      print(stats, file=sys.stderr)
+    else:
+      cipher.translate_file(src, dst, decrypt=args.mode == "decrypt", chunk_size=args.chunk_size)
+  finally:
+    if src not in (sys.stdin, sys.stdin.buffer):
+      src.close()
+    if dst not in (sys.stdout, sys.stdout.buffer):
+      dst.close()
+  return 0
+
+"""### Parallel
+Every character is encrypted on its own, so big inputs can be split into chunks and encrypted on several cores at the same time. The workers only get the `shift`, the alphabet and a chunk; each of them builds its `Cipher` once.
+
+- `parallel_translate` and `parallel_translate_file` keep the chunks in order. At most a few chunks per process are in flight, so a big file is still not loaded at once.
+- `translate_files` encrypts many files, one file per task, into `path + suffix`.
+- They all return a `Throughput` with the MB/s in total and per process. `parallel_translate` returns the translated data too, as `(data, throughput)`.
+"""
+
+import time
+import functools
+import collections
+import multiprocessing as mp
+
+@functools.lru_cache(maxsize=None)
+def _worker_cipher(shift, alphabet):
+  return Cipher(shift, alphabet)
+
+def _translate_chunk(job):
+  shift, alphabet, decrypt, chunk = job
+  return _worker_cipher(shift, alphabet).translate(chunk, decrypt)
+
+def _translate_path(job):
+  shift, alphabet, decrypt, path, out_path, chunk_size = job
+  with open(path, "rb") as src, open(out_path, "wb") as dst:
+    return _worker_cipher(shift, alphabet).translate_file(src, dst, decrypt, chunk_size)
+
+class Throughput(collections.namedtuple("Throughput", ["size", "seconds", "processes"])):
+  @property
+  def mb_per_s(self):
+    return self.size / 1e6 / max(self.seconds, 1e-9)
+
+  @property
+  def mb_per_s_per_core(self):
+    return self.mb_per_s / self.processes
+
+  def __str__(self):
+    return f"{self.size / 1e6:.1f} MB in {self.seconds:.2f}s: {self.mb_per_s:.1f} MB/s, {self.mb_per_s_per_core:.1f} MB/s per core ({self.processes} processes)"
+
+def _ordered_map(pool, func, jobs, window):
+  """pool.imap, but with at most `window` jobs submitted at a time."""
+  pending = collections.deque()
+  for job in jobs:
+    pending.append(pool.apply_async(func, (job,)))
+    if len(pending) >= window:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def _parallel_chunks(cipher, chunks, decrypt, processes):
+  processes = processes or os.cpu_count() or 1
+  jobs = ((cipher.shift, cipher.alphabet, decrypt, chunk) for chunk in chunks)
+  with mp.Pool(processes) as pool:
+    yield from _ordered_map(pool, _translate_chunk, jobs, 2 * processes)
+
+def parallel_translate(cipher, data, decrypt=False, processes=None, chunk_size=1 << 22):
+  """Returns the translated data and the `Throughput`."""
+  processes = processes or os.cpu_count() or 1
+  since = time.perf_counter()
+  chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+  result = data[:0].join(_parallel_chunks(cipher, chunks, decrypt, processes))
+  return result, Throughput(len(result), time.perf_counter() - since, processes)
+
+def parallel_translate_file(cipher, src, dst, decrypt=False, processes=None, chunk_size=1 << 22):
+  processes = processes or os.cpu_count() or 1
+  since = time.perf_counter()
+  total = 0
+  chunks = iter(lambda: src.read(chunk_size), src.read(0))
+  for chunk in _parallel_chunks(cipher, chunks, decrypt, processes):
+    dst.write(chunk)
+    total += len(chunk)
+  return Throughput(total, time.perf_counter() - since, processes)
+
+def translate_files(cipher, paths, suffix=".enc", decrypt=False, processes=None, chunk_size=1 << 22):
+  processes = processes or os.cpu_count() or 1
+  since = time.perf_counter()
+  jobs = [(cipher.shift, cipher.alphabet, decrypt, path, path + suffix, chunk_size) for path in paths]
+  with mp.Pool(processes) as pool:
+    total = sum(pool.imap(_translate_path, jobs))
+  return Throughput(total, time.perf_counter() - since, processes)
+
+"""### Benchmark
+Before we accept a faster `encrypt` we want to know it is really faster, so `benchmark` measures characters per second for message sizes from 10 B to 100 MB and for different kinds of messages:
+
+- `letters`: only `string.ascii_letters`
+- `full`: the whole alphabet
+- `unknown`: a quarter of the characters are not in the alphabet (they go through `_Table.__missing__`)
+- `bytes`: the `full` message as ASCII bytes (the fast path)
+
+Every run is appended as a JSON line to `results_path` together with the ratio to the previous run with the same size and kind, so a slowdown shows up as a ratio below 1. Run it with `python oop_tdd.py bench`.
+
+`reference_encrypt` is the original `find`-based loop (for any shift). It is slow, but it's obviously right, so the property tests below compare the fast versions with it.
+"""
+
+import json
+import random
+import platform
+
+def reference_encrypt(message, shift=1, alphabet=ABC):
+  result = []
+  for char in message:
+    idx = alphabet.find(char) # -1 if it's not in the alphabet
+    result.append(alphabet[(idx + shift) % len(alphabet)] if idx >= 0 else alphabet[(shift - 1) % len(alphabet)])
+  return "".join(result)
+
+BENCH_SIZES = [10, 1_000, 100_000, 10_000_000, 100_000_000]
+BENCH_KINDS = ["letters", "full", "unknown", "bytes"]
+
+def _bench_message(kind, size, seed=0):
+  rng = random.Random(seed)
+  pool = string.ascii_letters if kind == "letters" else ABC
+  block = rng.choices(pool, k=min(size, 1 << 16))
+  if kind == "unknown":
+    for i in range(0, len(block), 4):
+      block[i] = rng.choice("\u00e9\u00fc\u00df\n\t\u20ac")
+  block = "".join(block)
+  message = (block * (size // len(block) + 1))[:size] # repeat a random block, it's much faster to build
+  return message.encode("ascii") if kind == "bytes" else message
+
+def _chars_per_second(func, message, min_time=0.2, repeat=3):
+  best = float("inf")
+  for _ in range(repeat):
+    loops, since = 0, time.perf_counter()
+    while True:
+      func(message)
+      loops += 1
+      elapsed = time.perf_counter() - since
+      if elapsed >= min_time or len(message) >= 10_000_000:
+        break
+    best = min(best, elapsed / loops)
+  return len(message) / best
+
+def benchmark(sizes=BENCH_SIZES, kinds=BENCH_KINDS, results_path="cipher_bench.jsonl", repeat=3):
+  previous = {}
+  if results_path and os.path.exists(results_path):
+    with open(results_path) as f:
+      for line in f:
+        row = json.loads(line)
+        previous[(row["kind"], row["size"])] = row["chars_per_s"]
+  rows = []
+  for kind in kinds:
+    for size in sizes:
+      message = _bench_message(kind, size)
+      func = _cipher.translate if kind == "bytes" else encrypt
+      speed = _chars_per_second(func, message, repeat=repeat)
+      old = previous.get((kind, size))
+      rows.append({"kind": kind, "size": size, "chars_per_s": speed, "ratio": speed / old if old else None,
+                   "python": platform.python_version(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")})
+      ratio = f"  x{rows[-1]['ratio']:.2f}" if old else ""
+      print(f"{kind:>8} {size:>11,} chars: {speed / 1e6:9.1f} M chars/s{ratio}")
+      del message
+  if results_path:
+    with open(results_path, "a") as f:
+      for row in rows:
+        f.write(json.dumps(row) + "\n")
+  return rows
 
 class TestEncryption(unittest.TestCase):
   def setUp(self):
@@ -53,4 +335,104 @@ class TestEncryption(unittest.TestCase):
     encrypted_message = "".join([abc[abc.find(char) + 1] if len(abc)> (abc.find(char)+1) else abc[0] for idx, char in enumerate(self.my_message)])
     print(encrypted_message)
     self.assertEqual(encrypted_message, encrypt(self.my_message))
-unittest.main(argv=[''], verbosity=2, exit=False)
\ No newline at end of file
+
+  def test_wrapsToFirstCharacter(self):
+    self.assertEqual(encrypt(" "), ABC[0])
+    self.assertEqual(encrypt("\u00e9\n"), ABC[0]*2) # not in the alphabet
+
+  def test_decrypt(self):
+    self.assertEqual(decrypt(encrypt(self.my_message)), self.my_message)
+
+  def test_otherShifts(self):
+    for shift in (0, 3, len(ABC) - 1, -5):
+      cipher = Cipher(shift)
+      self.assertEqual(cipher.decrypt(cipher.encrypt(ABC)), ABC)
+    self.assertEqual(Cipher(3, alphabet="abc").encrypt("abcd"), "abcc")
+
+  def test_bytesMatchesText(self):
+    message = self.my_message + "\x00~\x7f"
+    self.assertEqual(_cipher.translate(message.encode("ascii")), encrypt(message).encode("ascii"))
+    self.assertEqual(_cipher.translate(encrypt(message).encode("ascii"), decrypt=True), decrypt(encrypt(message)).encode("ascii"))
+
+  def test_stream(self):
+    chunks = [self.my_message[i:i + 4] for i in range(0, len(self.my_message), 4)]
+    self.assertEqual("".join(_cipher.stream(chunks)), encrypt(self.my_message))
+    src, dst = io.BytesIO(self.my_message.encode() * 100), io.BytesIO()
+    self.assertEqual(_cipher.translate_file(src, dst, chunk_size=7), len(self.my_message) * 100)
+    self.assertEqual(dst.getvalue(), encrypt(self.my_message * 100).encode())
+
+  def test_parallelMatchesSerial(self):
+    message = (self.my_message + "\u00e9~\n") * 50
+    self.assertEqual(parallel_translate(_cipher, message, processes=2, chunk_size=7)[0], encrypt(message))
+    data = message.encode("utf-8")
+    result, stats = parallel_translate(_cipher, data, processes=2, chunk_size=7)
+    self.assertEqual(result, _cipher.translate(data))
+    self.assertEqual((stats.size, stats.processes), (len(data), 2))
+    dst = io.BytesIO()
+    stats = parallel_translate_file(_cipher, io.BytesIO(data), dst, processes=2, chunk_size=7)
+    self.assertEqual(dst.getvalue(), _cipher.translate(data))
+    self.assertEqual(stats.size, len(data))
+
+  def test_parallelFiles(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      paths = [os.path.join(tmp, f"{i}.log") for i in range(3)]
+      for i, path in enumerate(paths):
+        with open(path, "wb") as f:
+          f.write(self.my_message.encode() * (i + 1))
+      translate_files(_cipher, paths, processes=2)
+      for i, path in enumerate(paths):
+        with open(path + ".enc", "rb") as f:
+          self.assertEqual(f.read(), encrypt(self.my_message * (i + 1)).encode())
+
+"""### Property tests
+Instead of one fixed message, these tests try a lot of random messages, alphabets and shifts (with a fixed seed, so a failure can be reproduced) and check properties that must always hold."""
+
+class TestCipherProperties(unittest.TestCase):
+  N_CASES = 200
+
+  def setUp(self):
+    self.rng = random.Random(1234)
+
+  def random_cipher(self):
+    alphabet = "".join(self.rng.sample(ABC, self.rng.randint(1, len(ABC))))
+    return Cipher(self.rng.randint(-2 * len(alphabet), 2 * len(alphabet)), alphabet)
+
+  def random_message(self, alphabet, max_len=200):
+    pool = alphabet + "\u00e9\n\t\u20ac" # some characters are not in the alphabet
+    return "".join(self.rng.choices(pool, k=self.rng.randint(0, max_len)))
+
+  def test_matchesReference(self):
+    for _ in range(self.N_CASES):
+      cipher = self.random_cipher()
+      message = self.random_message(cipher.alphabet)
+      self.assertEqual(cipher.encrypt(message), reference_encrypt(message, cipher.shift, cipher.alphabet))
+
+  def test_roundTrip(self):
+    for _ in range(self.N_CASES):
+      cipher = self.random_cipher()
+      message = "".join(self.rng.choices(cipher.alphabet, k=self.rng.randint(0, 200)))
+      self.assertEqual(cipher.decrypt(cipher.encrypt(message)), message)
+      self.assertEqual(len(cipher.encrypt(message)), len(message))
+
+  def test_bytesMatchesText(self):
+    for _ in range(self.N_CASES):
+      cipher = self.random_cipher()
+      message = "".join(self.rng.choices([chr(i) for i in range(128)], k=self.rng.randint(0, 200)))
+      self.assertEqual(cipher.translate(message.encode("ascii")), cipher.encrypt(message).encode("ascii"))
+
+  def test_chunkingDoesNotMatter(self):
+    for _ in range(self.N_CASES // 10):
+      cipher = self.random_cipher()
+      message = self.random_message(cipher.alphabet, max_len=2000)
+      size = self.rng.randint(1, 50)
+      chunks = [message[i:i + size] for i in range(0, len(message), size)]
+      self.assertEqual("".join(cipher.stream(chunks)), cipher.encrypt(message))
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1 and sys.argv[1] in ("encrypt", "decrypt"):
+    sys.exit(main())
+  if len(sys.argv) > 1 and sys.argv[1] == "bench":
+    max_size = int(sys.argv[2]) if len(sys.argv) > 2 else BENCH_SIZES[-1]
+    benchmark(sizes=[size for size in BENCH_SIZES if size <= max_size])
+    sys.exit(0)
+  unittest.main(argv=[''], verbosity=2, exit=False)
\ No newline at end of file
@@ -14,3 +14,531 @@ For this tutorial, we will be finetuning a pre-trained [Mask R-CNN](https://arxi
 It contains 170 images with 345 labeled pedestrians, and we will use it to illustrate how to use the new features in torchvision in order to train an instance segmentation model on a custom dataset.
 """
 
+"""## Getting the data
+Download the [dataset](https://www.cis.upenn.edu/~jshi/ped_html/PennFudanPed.zip) and unzip it. The folder looks like this:
+
+```
+PennFudanPed/
+  PedMasks/
+    FudanPed00001_mask.png
+    ...
+  PNGImages/
+    FudanPed00001.png
+    ...
+```
+Every mask is a PNG where `0` is the background and every pedestrian has its own value (1, 2, 3, ...).
+"""
+
+# !wget https://www.cis.upenn.edu/~jshi/ped_html/PennFudanPed.zip .
+# !unzip PennFudanPed.zip
+
+"""Importing this file doesn't load, train or download anything: torchvision is imported inside the functions that need it and the whole pipeline runs from `main()` at the end (`python ObjectDetectionFinetuning.py`). So the dataset, the evaluator or the `DetectionEngine` can be reused from other scripts without paying for it."""
+
+import os
+import numpy as np
+import torch
+from PIL import Image
+
+"""## Writing the dataset
+The dataset has to return for every image a dictionary (the *target*) with:
+- *boxes*: `[N, 4]` coordinates of the N boxes in `[x0, y0, x1, y1]` format
+- *labels*: the class of every box, here always `1` (pedestrian), `0` is the background
+- *masks*: `[N, H, W]` one binary mask per pedestrian
+- *image_id*, *area* and *iscrowd*, which are used by the evaluation
+
+### Caching the masks
+Usually the mask PNG is decoded in `__getitem__` and `np.unique` finds the pedestrians and their boxes, every time an image is loaded, for every epoch. That's the slowest part of the loader and the result never changes. So we do it only once per image:
+
+- the masks are stored with `np.packbits` (1 bit per pixel) together with the boxes in a small `.npz` file in `cache_dir`
+- the cache is kept in memory after it is read, and `__getitem__` only has to load the image and unpack the masks
+- if a mask PNG is newer than its cache file, the cache is built again
+"""
+
+class PennFudanDataset(torch.utils.data.Dataset):
+    def __init__(self, root, transforms=None, cache_dir=None):
+        self.root = root
+        self.transforms = transforms
+        # sort them to make sure that the images and the masks are aligned
+        self.imgs = sorted(os.listdir(os.path.join(root, "PNGImages")))
+        self.masks = sorted(os.listdir(os.path.join(root, "PedMasks")))
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(root, "mask_cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._cache = {}
+
+    @staticmethod
+    def decode_mask(mask_path):
+        mask = np.array(Image.open(mask_path))
+        obj_ids = np.unique(mask)[1:] # the first id is the background
+        masks = mask == obj_ids[:, None, None] # one boolean mask per pedestrian
+        # the boxes from the rows and columns where every mask is set
+        rows, cols = masks.any(axis=2), masks.any(axis=1)
+        boxes = np.zeros((len(obj_ids), 4), dtype=np.float32)
+        for i in range(len(obj_ids)):
+            ys, xs = np.flatnonzero(rows[i]), np.flatnonzero(cols[i])
+            boxes[i] = [xs[0], ys[0], xs[-1], ys[-1]]
+        keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1]) # no empty boxes
+        return masks[keep], boxes[keep]
+
+    def cached_masks(self, idx):
+        """(packed masks, mask shape, boxes) of the image, decoded only the first time."""
+        if idx in self._cache:
+            return self._cache[idx]
+        mask_path = os.path.join(self.root, "PedMasks", self.masks[idx])
+        cache_path = os.path.join(self.cache_dir, os.path.splitext(self.masks[idx])[0] + ".npz")
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(mask_path):
+            masks, boxes = self.decode_mask(mask_path)
+            tmp_path = cache_path + ".tmp.npz"
+            np.savez(tmp_path, packed=np.packbits(masks, axis=-1), shape=np.array(masks.shape), boxes=boxes)
+            os.replace(tmp_path, cache_path) # so a half written file is never read
+        with np.load(cache_path) as data:
+            entry = (data["packed"], tuple(data["shape"]), data["boxes"])
+        self._cache[idx] = entry
+        return entry
+
+    def build_cache(self):
+        for idx in range(len(self)):
+            self.cached_masks(idx)
+
+    def __getitem__(self, idx):
+        img = Image.open(os.path.join(self.root, "PNGImages", self.imgs[idx])).convert("RGB")
+        packed, shape, boxes = self.cached_masks(idx)
+        masks = np.unpackbits(packed, axis=-1, count=shape[-1]).reshape(shape)
+
+        boxes = torch.as_tensor(boxes, dtype=torch.float32)
+        target = {
+            "boxes": boxes,
+            "labels": torch.ones((len(boxes),), dtype=torch.int64), # there is only one class
+            "masks": torch.from_numpy(masks),
+            "image_id": torch.tensor([idx]),
+            "area": (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0]),
+            "iscrowd": torch.zeros((len(boxes),), dtype=torch.int64), # suppose all instances are not crowd
+        }
+        if self.transforms is not None:
+            img, target = self.transforms(img, target)
+        return img, target
+
+    def __len__(self):
+        return len(self.imgs)
+
+"""Let's have a look at what the dataset returns. The first time it takes a bit longer because the masks are decoded and cached."""
+
+def show_first_sample(root='PennFudanPed/'):
+    dataset = PennFudanDataset(root)
+    dataset.build_cache()
+    print(dataset[0])
+
+"""## Defining the model
+We start from a Mask R-CNN pretrained on COCO and replace its two heads (boxes and masks) so that they predict our 2 classes: background and pedestrian.
+
+### Training on the CPU
+Mask R-CNN is big and our training hosts have no GPU, so `get_model_instance_segmentation` has a few knobs to make it lighter:
+- *trainable_layers*
+
+  how many of the 5 ResNet stages are trained, counted from the top. With `0` the whole backbone is frozen, so no gradients are computed for it and backward is much cheaper.
+- *min_size, max_size*
+
+  the images are resized so that the short side is `min_size` (but the long side at most `max_size`). The default is 800/1333, but the Penn-Fudan images are only around 300-500 pixels, so 480/800 loses almost nothing and every layer gets a lot cheaper.
+- *rpn_proposals*
+
+  how many proposals of the RPN are kept after NMS and sent to the heads. The default is 2000 during training and 1000 for testing, which is way more than the few pedestrians per image.
+"""
+
+import time
+
+def get_model_instance_segmentation(num_classes, trainable_layers=3, min_size=800, max_size=1333,
+                                    rpn_proposals=None, detections_per_img=100):
+    import torchvision
+    from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
+    from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
+    kwargs = {}
+    if rpn_proposals is not None:
+        kwargs = {
+            "rpn_pre_nms_top_n_train": 2 * rpn_proposals, "rpn_post_nms_top_n_train": rpn_proposals,
+            "rpn_pre_nms_top_n_test": 2 * rpn_proposals, "rpn_post_nms_top_n_test": rpn_proposals,
+        }
+    # load an instance segmentation model pre-trained on COCO
+    model = torchvision.models.detection.maskrcnn_resnet50_fpn(
+        pretrained=True, trainable_backbone_layers=trainable_layers, min_size=min_size, max_size=max_size,
+        box_detections_per_img=detections_per_img, **kwargs)
+
+    # replace the box predictor with a new one for our classes
+    in_features = model.roi_heads.box_predictor.cls_score.in_features
+    model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
+
+    # and the same for the mask predictor
+    in_features_mask = model.roi_heads.mask_predictor.conv5_mask.in_channels
+    hidden_layer = 256
+    model.roi_heads.mask_predictor = MaskRCNNPredictor(in_features_mask, hidden_layer, num_classes)
+    return model
+
+"""## Transforms
+The transforms have to change the target too: if the image is flipped, the boxes and the masks have to be flipped with it."""
+
+import random
+
+class Compose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, image, target):
+        for t in self.transforms:
+            image, target = t(image, target)
+        return image, target
+
+class ToTensor:
+    def __call__(self, image, target):
+        import torchvision.transforms.functional as TF
+        return TF.to_tensor(image), target
+
+class RandomHorizontalFlip:
+    def __init__(self, prob=0.5):
+        self.prob = prob
+
+    def __call__(self, image, target):
+        if random.random() < self.prob:
+            width = image.shape[-1]
+            image = image.flip(-1)
+            boxes = target["boxes"].clone()
+            boxes[:, [0, 2]] = width - target["boxes"][:, [2, 0]]
+            target = dict(target, boxes=boxes, masks=target["masks"].flip(-1))
+        return image, target
+
+def get_transform(train):
+    transforms = [ToTensor()]
+    if train:
+        transforms.append(RandomHorizontalFlip(0.5))
+    return Compose(transforms)
+
+"""## Grouping the batches by aspect ratio
+The images of a batch are padded to the same size before they go through the network. If a tall image and a wide image end up in the same batch, most of the batch is padding and we compute a lot for nothing. `GroupedBatchSampler` puts every image in a group by its aspect ratio (`width / height`, read from the PNG header, so it's cheap) and only builds batches out of the same group.
+"""
+
+import bisect
+
+def image_aspect_ratios(dataset):
+    ratios = []
+    for name in dataset.imgs:
+        with Image.open(os.path.join(dataset.root, "PNGImages", name)) as img: # only reads the header
+            width, height = img.size
+        ratios.append(width / height)
+    return ratios
+
+class GroupedBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, aspect_ratios, batch_size, bins=(0.5, 0.75, 1.0, 1.5, 2.0), shuffle=True, drop_last=False):
+        self.groups = [bisect.bisect_right(bins, ratio) for ratio in aspect_ratios]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = torch.randperm(len(self.groups)).tolist() if self.shuffle else range(len(self.groups))
+        buffers = {}
+        for idx in order:
+            buffer = buffers.setdefault(self.groups[idx], [])
+            buffer.append(idx)
+            if len(buffer) == self.batch_size:
+                yield buffer
+                buffers[self.groups[idx]] = []
+        if not self.drop_last:
+            for buffer in buffers.values():
+                if buffer:
+                    yield buffer
+
+    def __len__(self):
+        counts = {}
+        for group in self.groups:
+            counts[group] = counts.get(group, 0) + 1
+        if self.drop_last:
+            return sum(n // self.batch_size for n in counts.values())
+        return sum((n + self.batch_size - 1) // self.batch_size for n in counts.values())
+
+def collate_fn(batch):
+    return tuple(zip(*batch))
+
+"""## Training
+`train_one_epoch` is a usual training loop, but it also measures how long every iteration takes, split into waiting for the data and the forward/backward pass. This way we can see if it's the loader or the model that is slow.
+
+The model returns a dictionary of losses in training mode (classifier, box regression, mask, objectness and RPN box), we just add them up.
+"""
+
+def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq=10):
+    model.train()
+    data_time = iter_time = 0.0
+    end = time.time()
+    for i, (images, targets) in enumerate(data_loader):
+        data_time += time.time() - end
+        images = [image.to(device) for image in images]
+        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+
+        loss_dict = model(images, targets)
+        losses = sum(loss for loss in loss_dict.values())
+
+        optimizer.zero_grad()
+        losses.backward()
+        optimizer.step()
+
+        iter_time += time.time() - end
+        end = time.time()
+        if i % print_freq == 0 or i == len(data_loader) - 1:
+            n = i + 1
+            print(f"Epoch {epoch} [{n}/{len(data_loader)}] loss: {losses.item():.4f} "
+                  f"time/it: {iter_time / n:.3f}s (data: {data_time / n:.3f}s)")
+    return iter_time / len(data_loader)
+
+"""## Evaluation
+We measure the COCO-style mean average precision (mAP, averaged over the IoU thresholds 0.50, 0.55, ..., 0.95) for the boxes and for the masks. It's written with tensor operations so we don't need `pycocotools`, and evaluating after every epoch is quick:
+
+- For every image the IoUs between all predictions and all ground truths are computed at once: `box_iou` for the boxes and one matrix multiplication of the flattened masks for the masks.
+- The predictions are matched greedily in order of score (the best scoring prediction takes the ground truth with the highest IoU that is still free). The loop goes over the predictions, but all 10 IoU thresholds are matched at the same time. It skips the predictions that don't reach the lowest threshold with any ground truth and stops as soon as every ground truth is taken, since everything after that is a false positive anyway.
+- `update` only keeps the scores and a true-positive matrix per image. `summarize` sorts them once and computes precision/recall for all thresholds with `cumsum`, then the 101-point interpolated AP like COCO.
+"""
+
+def mask_iou(masks_a, masks_b):
+    a = masks_a.flatten(1).float()
+    b = masks_b.flatten(1).float()
+    inter = a @ b.T
+    union = a.sum(1)[:, None] + b.sum(1)[None, :] - inter
+    return inter / union.clamp(min=1)
+
+class DetectionEvaluator:
+    def __init__(self, iou_types=("bbox", "segm"), iou_thresholds=None, max_dets=100, mask_threshold=0.5):
+        self.iou_types = iou_types
+        self.iou_thresholds = iou_thresholds if iou_thresholds is not None else torch.linspace(0.5, 0.95, 10)
+        self.max_dets = max_dets
+        self.mask_threshold = mask_threshold
+        self.records = {t: {"scores": [], "labels": [], "tp": []} for t in iou_types}
+        self.n_gt = {} # number of ground truths per class
+
+    def match(self, ious, pred_labels, gt_labels):
+        """(T, D) boolean matrix: is prediction d a true positive at threshold t."""
+        thresholds = self.iou_thresholds.to(ious.device)
+        ious = torch.where(pred_labels[:, None] == gt_labels[None, :], ious, torch.full_like(ious, -1))
+        tp = torch.zeros((len(thresholds), len(pred_labels)), dtype=torch.bool, device=ious.device)
+        taken = torch.zeros((len(thresholds), len(gt_labels)), dtype=torch.bool, device=ious.device)
+        if len(gt_labels) == 0:
+            return tp
+        # only predictions that overlap some ground truth enough can ever be a true positive
+        candidates = (ious.max(dim=1).values >= thresholds.min()).nonzero().flatten().tolist()
+        for d in candidates: # predictions are sorted by score
+            best_iou, best_gt = ious[d].expand_as(taken).masked_fill(taken, -1).max(dim=1)
+            hit = best_iou >= thresholds
+            tp[:, d] = hit
+            taken[hit, best_gt[hit]] = True
+            if taken.all(): # every ground truth is matched at every threshold, the rest are false positives
+                break
+        return tp
+
+    def update(self, outputs, targets):
+        from torchvision.ops import box_iou
+        for output, target in zip(outputs, targets):
+            order = output["scores"].argsort(descending=True)[:self.max_dets]
+            scores, labels = output["scores"][order], output["labels"][order]
+            gt_labels = target["labels"].to(labels.device)
+            for label in gt_labels.tolist():
+                self.n_gt[label] = self.n_gt.get(label, 0) + 1
+            for iou_type in self.iou_types:
+                if iou_type == "bbox":
+                    ious = box_iou(output["boxes"][order], target["boxes"].to(labels.device))
+                else:
+                    pred_masks = output["masks"][order][:, 0] >= self.mask_threshold
+                    ious = mask_iou(pred_masks, target["masks"].to(labels.device))
+                record = self.records[iou_type]
+                record["scores"].append(scores.cpu())
+                record["labels"].append(labels.cpu())
+                record["tp"].append(self.match(ious, labels, gt_labels).cpu())
+
+    def average_precision(self, tp, n_gt):
+        """101-point interpolated AP for every threshold, tp is (T, D) sorted by score."""
+        tps = tp.float().cumsum(dim=1)
+        fps = (~tp).float().cumsum(dim=1)
+        recall = tps / max(n_gt, 1)
+        precision = tps / (tps + fps).clamp(min=1)
+        # make the precision monotonically decreasing (from the right)
+        precision = precision.flip(1).cummax(dim=1).values.flip(1)
+        points = torch.linspace(0, 1, 101)
+        ap = torch.zeros(len(tp))
+        for t in range(len(tp)):
+            idx = torch.searchsorted(recall[t].contiguous(), points, right=False)
+            valid = idx < recall.shape[1]
+            ap[t] = precision[t][idx[valid]].sum() / len(points)
+        return ap
+
+    def summarize(self):
+        results = {}
+        for iou_type in self.iou_types:
+            record = self.records[iou_type]
+            scores = torch.cat(record["scores"]) if record["scores"] else torch.zeros(0)
+            labels = torch.cat(record["labels"]) if record["labels"] else torch.zeros(0, dtype=torch.int64)
+            tp = torch.cat(record["tp"], dim=1) if record["tp"] else torch.zeros((len(self.iou_thresholds), 0), dtype=torch.bool)
+            per_class = []
+            for label, n_gt in self.n_gt.items():
+                mine = labels == label
+                order = scores[mine].argsort(descending=True)
+                per_class.append(self.average_precision(tp[:, mine][:, order], n_gt))
+            ap = torch.stack(per_class).mean(dim=0) if per_class else torch.zeros(len(self.iou_thresholds))
+            results[iou_type] = {"mAP": ap.mean().item(), "AP50": ap[0].item(), "AP75": ap[5].item() if len(ap) > 5 else float("nan")}
+            print(f"{iou_type}: mAP {results[iou_type]['mAP']:.3f}  AP50 {results[iou_type]['AP50']:.3f}  AP75 {results[iou_type]['AP75']:.3f}")
+        return results
+
+@torch.no_grad()
+def evaluate(model, data_loader, device):
+    model.eval()
+    evaluator = DetectionEvaluator()
+    since = time.time()
+    for images, targets in data_loader:
+        outputs = model([image.to(device) for image in images])
+        evaluator.update(outputs, targets)
+    results = evaluator.summarize()
+    print(f"Evaluation took {time.time() - since:.1f}s")
+    return results
+
+"""### Putting everything together
+We keep 50 images for testing. On the CPU we freeze the backbone, use smaller images and fewer proposals. With a GPU you can use `trainable_layers=3`, the default sizes and no limit for the proposals.
+"""
+
+def main(root='PennFudanPed', num_epochs=10):
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    on_cpu = device.type == 'cpu'
+    if on_cpu:
+        torch.set_num_threads(os.cpu_count()) # use all the cores
+
+    # our dataset has two classes only - background and person
+    num_classes = 2
+    dataset = PennFudanDataset(root, get_transform(train=True))
+    dataset_test = PennFudanDataset(root, get_transform(train=False))
+
+    # split the dataset in train and test set
+    indices = torch.randperm(len(dataset)).tolist()
+    dataset = torch.utils.data.Subset(dataset, indices[:-50])
+    dataset_test = torch.utils.data.Subset(dataset_test, indices[-50:])
+
+    ratios = image_aspect_ratios(dataset.dataset)
+    train_sampler = GroupedBatchSampler([ratios[i] for i in dataset.indices], batch_size=2)
+    data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_sampler, num_workers=4,
+                                              collate_fn=collate_fn)
+    data_loader_test = torch.utils.data.DataLoader(dataset_test, batch_size=1, shuffle=False, num_workers=4,
+                                                   collate_fn=collate_fn)
+
+    model = get_model_instance_segmentation(num_classes,
+                                            trainable_layers=0 if on_cpu else 3,
+                                            min_size=480 if on_cpu else 800,
+                                            max_size=800 if on_cpu else 1333,
+                                            rpn_proposals=300 if on_cpu else None)
+    model.to(device)
+
+    # only the parameters that are not frozen
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=0.005, momentum=0.9, weight_decay=0.0005)
+    # and a learning rate scheduler which decreases the learning rate by 10x every 3 epochs
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=3, gamma=0.1)
+
+    for epoch in range(num_epochs):
+        train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq=10)
+        lr_scheduler.step()
+        # evaluate on the test dataset
+        evaluate(model, data_loader_test, device=device)
+
+    run_inference(model, dataset_test, device, tile_size=800 if on_cpu else 1333)
+
+"""## Inference
+For every detection the model returns a mask of the size of the whole image with a float per pixel. For the high resolution frames of our cameras that's far too much memory (a 4000x3000 frame with 20 people is ~1 GB of masks). `DetectionEngine` does the inference in a lighter way:
+
+- The model itself only keeps the detections with a score of at least `score_threshold`, and at most `max_detections` per image or tile (it sets `roi_heads.score_thresh` and `roi_heads.detections_per_img`; by default Mask R-CNN keeps 100 and pastes a full-size mask for every one of them, even the ones we would throw away). Note that this changes the model that is given to it.
+- Images of the same size go through the model together in batches of `batch_size`.
+- Frames bigger than `tile_size` are cut into overlapping tiles (all the same size, so they batch well). The detections of the tiles are moved back to frame coordinates and the duplicates in the overlaps are removed with `torchvision.ops.batched_nms`.
+- The masks are thresholded, cropped to their box and run-length encoded (`rle_encode`), so a mask only costs a few numbers. `rle_decode` gives back the boolean mask of the box.
+"""
+
+def rle_encode(mask):
+    """Run-length encoding of a 2D boolean mask (column by column, starting with a run of 0s)."""
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], changes, [flat.size]])
+    counts = np.diff(bounds)
+    if flat.size and flat[0]:
+        counts = np.concatenate([[0], counts]) # the first run is always 0s
+    return {"size": list(mask.shape), "counts": counts.astype(np.int32)}
+
+def rle_decode(rle):
+    counts = np.asarray(rle["counts"])
+    values = np.arange(len(counts)) % 2 == 1
+    flat = np.repeat(values, counts)
+    return flat.reshape(rle["size"], order="F")
+
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    return starts + [length - tile] # the last tile ends at the border
+
+class DetectionEngine:
+    def __init__(self, model, device, batch_size=4, tile_size=1333, overlap=128, score_threshold=0.5,
+                 mask_threshold=0.5, nms_iou=0.5, max_detections=20):
+        self.model = model.to(device).eval()
+        # drop the weak detections inside the model, before it pastes a full-size mask for each of them
+        self.model.roi_heads.score_thresh = score_threshold
+        self.model.roi_heads.detections_per_img = max_detections
+        self.device = device
+        self.batch_size = batch_size
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.score_threshold = score_threshold
+        self.mask_threshold = mask_threshold
+        self.nms_iou = nms_iou
+
+    def _pieces(self, images):
+        """(image index, x offset, y offset, crop) for every image or tile."""
+        for i, image in enumerate(images):
+            h, w = image.shape[-2:]
+            th, tw = min(h, self.tile_size), min(w, self.tile_size)
+            for y in tile_starts(h, th, self.overlap):
+                for x in tile_starts(w, tw, self.overlap):
+                    yield i, x, y, image[:, y:y + th, x:x + tw]
+
+    def _encode(self, output, x_off, y_off):
+        keep = output["scores"] >= self.score_threshold
+        boxes, masks = output["boxes"][keep], output["masks"][keep]
+        rles = []
+        for box, mask in zip(boxes.round().int().tolist(), masks[:, 0]):
+            x0, y0, x1, y1 = box
+            crop = mask[y0:y1 + 1, x0:x1 + 1] >= self.mask_threshold
+            rles.append(dict(rle_encode(crop.cpu().numpy()), box=[x0 + x_off, y0 + y_off, x1 + x_off, y1 + y_off]))
+        offset = torch.tensor([x_off, y_off, x_off, y_off], dtype=boxes.dtype, device=boxes.device)
+        return boxes + offset, output["scores"][keep], output["labels"][keep], rles
+
+    @torch.no_grad()
+    def predict(self, images):
+        """A list of [C, H, W] image tensors -> a list of dicts with boxes, scores, labels and RLE masks."""
+        from torchvision.ops import batched_nms
+        pieces = sorted(self._pieces(images), key=lambda p: tuple(p[3].shape[-2:])) # similar sizes together
+        found = [[] for _ in images]
+        for start in range(0, len(pieces), self.batch_size):
+            batch = pieces[start:start + self.batch_size]
+            outputs = self.model([crop.to(self.device) for _, _, _, crop in batch])
+            for (i, x, y, _), output in zip(batch, outputs):
+                found[i].append(self._encode(output, x, y))
+
+        results = []
+        for parts in found:
+            boxes = torch.cat([p[0] for p in parts])
+            scores = torch.cat([p[1] for p in parts])
+            labels = torch.cat([p[2] for p in parts])
+            rles = [rle for p in parts for rle in p[3]]
+            if len(parts) > 1: # tiles overlap, remove the duplicates
+                keep = batched_nms(boxes, scores, labels, self.nms_iou)
+                boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+                rles = [rles[k] for k in keep.tolist()]
+            results.append({"boxes": boxes.cpu(), "scores": scores.cpu(), "labels": labels.cpu(), "masks": rles})
+        return results
+
+"""Let's try it on a few test images. `rle_decode` gives us back the mask of the first pedestrian inside its box."""
+
+def run_inference(model, dataset_test, device, tile_size=1333):
+    engine = DetectionEngine(model, device, tile_size=tile_size)
+    test_images = [dataset_test[i][0] for i in range(4)]
+    predictions = engine.predict(test_images)
+    print(predictions[0]["boxes"], predictions[0]["scores"])
+    return Image.fromarray(rle_decode(predictions[0]["masks"][0]).astype(np.uint8) * 255)
+
+if __name__ == "__main__":
+    main()
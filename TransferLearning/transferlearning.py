@@ -31,27 +31,46 @@ from torch.optim import lr_scheduler  #A Learning rate schedule is a predefined
 #adjusts the learning rate between epochs or iterations as the training progresses
 import torch.backends.cudnn as cudnn  #torch.backends controls the behavior of various backends that PyTorch supports.
 import numpy as np
-import torchvision  #Torchvision provides many built-in datasets in the torchvision.datasets module,
-#as well as utility classes for building your own datasets.
-from torchvision import datasets, models, transforms
-import matplotlib.pyplot as plt #a collection of command style functions that make matplotlib work like MATLAB.
 import time #Python time module allows to work with time in Python
 import os #provides functions for creating and removing a directory (folder), fetching its contents,
 # changing and identifying the current directory, etc.
 import copy #It means that any changes made to a copy of object do reflect in the original object.
+import sys
+import importlib.util
+
+"""### Lazy imports
+Other scripts import this file to reuse `train_model` and the other functions, and importing torchvision and matplotlib takes a few seconds. `lazy_import` returns a module that is only really imported the first time one of its attributes is used, so `import transferlearning` stays quick. matplotlib is imported inside the functions that plot.
+"""
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+torchvision = lazy_import('torchvision')  #Torchvision provides many built-in datasets in the torchvision.datasets module,
+#as well as utility classes for building your own datasets.
 
 """## Hardware 
 
 This flag allows you to enable the inbuilt cudnn auto-tuner to find the best algorithm to use for your hardware. Use it if your model does not change and your input sizes remain the same
 """
 
-cudnn.benchmark = True
+def setup_hardware():
+    cudnn.benchmark = True
 
 """## Plotting
 Turns on the interactive mode of matplotlib.pyplot, in which the graph display gets updated after each statement.
 """
 
-plt.ion()
+def setup_plotting():
+    import matplotlib.pyplot as plt #a collection of command style functions that make matplotlib work like MATLAB.
+    plt.ion()
 
 """## The Problem
 Train a model to classify ants and bees. We have about 120 training images each for ants and bees. There are 75 validation images for each class. Usually, this is a very small dataset to generalize upon, if trained from scratch. Since we are using transfer learning, the network has already learnet useful features and we should be able to generalize reasonably well.
@@ -86,22 +105,24 @@ Crops the given image at the center.
   - size (sequence or int): Desired output size of the crop. If size is an int instead of sequence like (h, w), a square crop (size, size) is made.
 """
 
-# Data augmentation and normalization for training
-# Just normalization for validation
-data_transforms = {
-    'train' : transforms.Compose([
-                                  transforms.RandomResizedCrop(224), #augmenting
-                                  transforms.RandomHorizontalFlip(), #augmenting
-                                  transforms.ToTensor(), #pytorch can read it now
-                                  transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-                                  ]), #mean and std for 3 channels of RGB
-    'val' : transforms.Compose([
-                                transforms.Resize(256),
-                                transforms.CenterCrop(224), #to get the actual object to classify
-                                transforms.ToTensor(),
-                                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ]),
-}
+def get_data_transforms():
+    transforms = torchvision.transforms
+    # Data augmentation and normalization for training
+    # Just normalization for validation
+    return {
+        'train' : transforms.Compose([
+                                      transforms.RandomResizedCrop(224), #augmenting
+                                      transforms.RandomHorizontalFlip(), #augmenting
+                                      transforms.ToTensor(), #pytorch can read it now
+                                      transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                                      ]), #mean and std for 3 channels of RGB
+        'val' : transforms.Compose([
+                                    transforms.Resize(256),
+                                    transforms.CenterCrop(224), #to get the actual object to classify
+                                    transforms.ToTensor(),
+                                    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        ]),
+    }
 
 #Add the dataset to the google drive and mount it.
 data_dir = '/content/drive/MyDrive/Colab Notebooks/hymenoptera_data'
@@ -120,11 +141,11 @@ A generic data loader
 os.path module implements some useful functions on pathnames. Here it joins one or more path components intelligently.
 """
 
-image_datasets = {x: datasets.ImageFolder(os.path.join(data_dir, x),
-                                          data_transforms[x])
-                  for x in ['train', 'val']} #creating a dictionary
-
-image_datasets["val"] #to see the information
+def make_datasets(data_dir=data_dir):
+    data_transforms = get_data_transforms()
+    return {x: torchvision.datasets.ImageFolder(os.path.join(data_dir, x),
+                                                data_transforms[x])
+            for x in ['train', 'val']} #creating a dictionary
 
 """### Setting up the data loaders
 - ### *torch.utils.data.DataLoader*  
@@ -143,25 +164,37 @@ Combines a dataset and a sampler, and provides an iterable over the given datase
 
 """
 
-dataloaders = {x: torch.utils.data.DataLoader(image_datasets[x], batch_size=4,
-                                             shuffle=True, num_workers=4)
-              for x in ['train', 'val']}
+def make_dataloaders(image_datasets, batch_size=4, num_workers=4):
+    return {x: torch.utils.data.DataLoader(image_datasets[x], batch_size=batch_size,
+                                           shuffle=True, num_workers=num_workers)
+            for x in ['train', 'val']}
 
 """## Dataset sizes
 
 We will need the dataset sizes for calculating the loss and the accuracy when we are training. We can see here how many training and validation images we have.
 """
 
-dataset_sizes = {x: len(image_datasets[x]) for x in ['train', 'val']}
-dataset_sizes["train"], dataset_sizes["val"]
+def get_dataset_sizes(image_datasets):
+    return {x: len(image_datasets[x]) for x in ['train', 'val']}
 
 """## Class Names
 
 Category 0 is ants and category 1 is bees.
 """
 
-class_names = image_datasets['train'].classes
-class_names
+"""Nothing above runs when the file is imported; `load_data` builds everything and keeps it in the module globals the rest of the tutorial uses. `main()` calls it."""
+
+image_datasets, dataloaders, dataset_sizes, class_names = {}, {}, {}, [] # filled by load_data
+
+def load_data(data_dir=data_dir, batch_size=4, num_workers=4):
+    global image_datasets, dataloaders, dataset_sizes, class_names
+    image_datasets = make_datasets(data_dir)
+    print(image_datasets["val"]) #to see the information
+    dataloaders = make_dataloaders(image_datasets, batch_size, num_workers)
+    dataset_sizes = get_dataset_sizes(image_datasets)
+    print(dataset_sizes["train"], dataset_sizes["val"])
+    class_names = image_datasets['train'].classes
+    print(class_names) # Category 0 is ants and category 1 is bees.
 
 """## Device for Training
 Even if you don't have an actual GPU, you can head to Colab and use the GPU there since it will speed up the process.
@@ -171,6 +204,20 @@ An object representing the device on which a torch.Tensor is or will be allocate
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+"""## Prefetching the batches
+`inputs.to(device)` copies a batch from normal (pageable) memory, and the GPU waits until the copy is done before it computes anything. `DevicePrefetcher` wraps a DataLoader and hides that copy:
+
+- On the GPU every batch is first copied into *pinned* (page-locked) host buffers, which are allocated once and reused, and then sent to the GPU with `non_blocking=True` on a separate CUDA stream. So batch N+1 is already on its way while the model works on batch N.
+- On a CPU-only machine there is nothing to copy, but a background thread still loads the next batches while the current one is trained on.
+
+The batches come out already on `device`, so the `.to(device)` calls in the loops cost nothing. The MNIST tutorial uses it too, so it is in `trainingtools.py` in the root of the repo. In Colab, upload `trainingtools.py` next to the notebook.
+"""
+
+# trainingtools.py is in the root of the repo. A notebook has no __file__, there it has to be next to the notebook
+here = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path += [here, os.path.join(here, os.pardir)]
+from trainingtools import DevicePrefetcher
+
 """## Visualizing a few Images
 
 Visualizing a few training images so as to understand the data augmentations. We are defining a function to do the task.
@@ -182,17 +229,25 @@ Since we had a normalization step before, here we have to revert the image to no
 
 """
 
+MEAN = torch.tensor([0.485, 0.456, 0.406]) # the same values as in transforms.Normalize
+STD = torch.tensor([0.229, 0.224, 0.225])
+
+def denormalize(images):
+    """Reverts transforms.Normalize for one image [C, H, W] or a whole batch [B, C, H, W] at once."""
+    shape = (-1, 1, 1)
+    mean = MEAN.to(images.device).view(shape)
+    std = STD.to(images.device).view(shape)
+    return (images * std + mean).clamp_(0, 1) #reverting the normalized image and clipping it to [0, 1]
+
 def imshow(inp, title=None):
     """Imshow for Tensor."""
-    inp = inp.numpy().transpose((1, 2, 0)) #transposes the data (x,y,z)->(y,z,x)
-    mean = np.array([0.485, 0.456, 0.406]) # Creates an array.
-    std = np.array([0.229, 0.224, 0.225])
-    inp = std * inp + mean #reverting the normalized image
-    inp = np.clip(inp, 0, 1) #Clip (limit) the values in an array.
-    plt.imshow(inp)
+    import matplotlib.pyplot as plt
+    inp = denormalize(inp.cpu()).permute(1, 2, 0) #transposes the data (x,y,z)->(y,z,x)
+    plt.imshow(inp.numpy())
     if title is not None:
         plt.title(title)
-    plt.pause(0.001)  # pause a bit so that plots are updated
+    if plt.isinteractive():
+        plt.pause(0.001)  # pause a bit so that plots are updated
 
 """Get a batch of training data.
 - #### *next(iter(dataloaders))*
@@ -209,9 +264,6 @@ The result:
   It will represent the class of images that will be visualized. (e.g. [0, 1, 1, 1] means first image is an ant the other 3 will be bees.)
 """
 
-inputs, classes = next(iter(dataloaders['train']))
-inputs.shape, classes
-
 """### Make a grid from batch
 - ### *torchvision.utils.make_grid(tensor: Union[torch.Tensor, List[torch.Tensor]])*
 Make a grid of images.
@@ -219,14 +271,165 @@ Make a grid of images.
 
 """
 
-out = torchvision.utils.make_grid(inputs)
-
 """Use the function to visualize some training images.
 
 The images are as we were expecting from the result of line 15.
 """
 
-imshow(out, title=[class_names[x] for x in classes])
+def show_training_batch():
+    inputs, classes = next(iter(dataloaders['train']))
+    print(inputs.shape, classes)
+    out = torchvision.utils.make_grid(inputs)
+    imshow(out, title=[class_names[x] for x in classes])
+
+"""## Checkpoints
+`train_model` keeps the best weights only in memory. If a run is killed at epoch 20 of 25, everything is lost, including the momentum of the optimizer and the state of the `StepLR` scheduler. With a `checkpoint_dir`, `train_model` saves everything it needs to continue exactly where it stopped: the model, optimizer and scheduler `state_dict`s, the random number generators (so the data is shuffled the same way), the epoch, `best_acc` and the best weights.
+
+- Writing to the disk can take a while, so `AsyncCheckpointer` does it in a background thread. The training loop only has to copy the tensors to the CPU (that's quick) and continues while the file is written. If the thread is still busy, only the newest checkpoint is kept in the queue.
+- The file is first written as `last.pt.tmp` and then renamed with `os.replace`, which is atomic: if the process dies while writing, the old checkpoint is still complete.
+- With `resume=True`, `train_model` loads `last.pt` (if there is one) and starts at the next epoch. A checkpoint only fits the run that wrote it, so it also keeps a *fingerprint* of that run (`run_fingerprint`): the model class and the shapes of its weights, the optimizer groups and their learning rates, the size and folder of the datasets and the `run_config` you give to `train_model`. If the fingerprint is not the same, `train_model` refuses to resume instead of loading the state of another run. Only `num_epochs` can change, so a run can be continued for more epochs.
+- The writer thread is always closed at the end of `train_model`, even if the training fails, so the last checkpoint is on the disk and an error while writing it is not lost.
+"""
+
+import random
+import threading
+import hashlib
+
+def _to_cpu(obj):
+    """A copy of a (nested) state with all tensors on the CPU, which the training can't change anymore."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def rng_states():
+    return {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate(),
+            'cuda': torch.cuda.get_rng_state_all() if device.type == 'cuda' else None}
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['python'])
+    if states['cuda'] is not None and device.type == 'cuda':
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+def run_fingerprint(model, optimizer, loaders, run_config=None):
+    """What a checkpoint has to match to be resumed."""
+    shapes = ';'.join(f'{name}:{tuple(t.shape)}' for name, t in model.state_dict().items())
+    data = {}
+    for phase, loader in loaders.items():
+        dataset = loader.dataset
+        while isinstance(dataset, torch.utils.data.Subset):
+            dataset = dataset.dataset
+        data[phase] = (len(loader.dataset), str(getattr(dataset, 'root', '')))
+    return {'model': type(model).__name__,
+            'weights': hashlib.sha1(shapes.encode()).hexdigest(),
+            'param_groups': [(len(g['params']), g.get('initial_lr', g['lr'])) for g in optimizer.param_groups],
+            'data': data,
+            'run_config': run_config}
+
+class AsyncCheckpointer:
+    def __init__(self, checkpoint_dir, filename='last.pt'):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.path = os.path.join(checkpoint_dir, filename)
+        self._pending = None
+        self._error = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                state, self._pending = self._pending, None
+            try:
+                torch.save(state, self.path + '.tmp')
+                os.replace(self.path + '.tmp', self.path) # atomic
+            except Exception as e:
+                self._error = e
+            with self._cond:
+                self._cond.notify_all()
+
+    def save(self, state):
+        if self._error is not None:
+            raise RuntimeError('writing the last checkpoint failed') from self._error
+        state = _to_cpu(state) # the only part the training loop waits for
+        with self._cond:
+            self._pending = state # replaces an older checkpoint that wasn't written yet
+            self._cond.notify_all()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        return torch.load(self.path, map_location='cpu', weights_only=False)
+
+    def close(self):
+        """Wait until the last checkpoint is on the disk."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError('writing the last checkpoint failed') from self._error
+
+"""## Early stopping
+The best validation accuracy often comes early, and the epochs after it are wasted. `EarlyStopping` watches the validation accuracy (`monitor='acc'`) or loss (`monitor='loss'`) and tells `train_model` to stop when it did not get better by at least `min_delta` for `patience` validations in a row.
+
+Validating also costs time, so `train_model` can validate only every `val_every` epochs (and always after the last one), or on a fixed random subset of `val_subset` images.
+"""
+
+class EarlyStopping:
+    def __init__(self, patience=None, monitor='acc', min_delta=0.0):
+        if monitor not in ('acc', 'loss'):
+            raise ValueError("monitor must be 'acc' or 'loss'")
+        self.patience = patience
+        self.sign = 1 if monitor == 'acc' else -1 # higher accuracy is better, lower loss is better
+        self.min_delta = min_delta
+        self.best = None
+        self.bad_rounds = 0
+
+    def step(self, value):
+        if self.best is None or self.sign * (value - self.best) > self.min_delta:
+            self.best = value
+            self.bad_rounds = 0
+        else:
+            self.bad_rounds += 1
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.bad_rounds >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'bad_rounds': self.bad_rounds}
+
+    def load_state_dict(self, state):
+        self.best = state.get('best')
+        self.bad_rounds = state.get('bad_rounds', 0)
+
+"""## Error analysis
+The validation accuracy tells us how many images are wrong, but not which ones. If `train_model` gets an `ErrorIndex`, it saves one row per validation image for every validation epoch: the index of the image in the dataset, its label, the predicted class, the confidence (the softmax probability of the prediction) and the loss of that image.
+
+The rows of an epoch are saved column by column (one numpy array per field) in `epoch_0007.npz`, and the file paths and the class names once in `meta.json`. That's about 20 bytes per image, so even 25k images are only ~0.5MB per epoch. The questions we usually have are then a few numpy operations over the columns instead of another run over the data:
+
+- `hardest(k)`: the `k` images with the highest loss.
+- `confusion_pairs()`: which (label, predicted) pairs happen the most.
+- `flips(a, b)`: the images that were right in epoch `a` and wrong in epoch `b` (`broke`), and the other way round (`fixed`).
+- `always_wrong(min_confidence)`: the images that are wrong in every epoch, with a high confidence. These are the first ones to check for a wrong label.
+
+A new run deletes the epochs that an earlier run left in the same folder when it saves its first epoch, otherwise the queries could read the last epoch of an older, longer run. With `resume=True` (what `run_finetuning(resume=True)` passes) they are kept, like the checkpoint.
+
+The validation loader is not shuffled when the rows are recorded, so the position in the loader tells us which image it is. `ErrorIndex` is in `trainingtools.py`, the Intro tutorials use it too.
+"""
+
+from trainingtools import ErrorIndex
 
 """## Training the model
 A general function to train a model.
@@ -258,65 +461,133 @@ Sets the gradients of all optimized torch.Tensor s to zero.
   The loss that you get is the average of the current batch. You multiply it with the batch size and you get the original loss.
 """
 
-def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
+def train_model(model, criterion, optimizer, scheduler, num_epochs=25, checkpoint_dir=None,
+                checkpoint_every=1, resume=True, patience=None, monitor='acc', min_delta=0.0,
+                val_every=1, val_subset=None, loaders=None, errors=None, run_config=None):
     since = time.time()
 
     best_model_wts = copy.deepcopy(model.state_dict())
     best_acc = 0.0
+    start_epoch = 0
+    stopping = EarlyStopping(patience, monitor, min_delta)
+
+    # other data loaders can be given, e.g. with another batch size
+    loaders = dict(loaders if loaders is not None else dataloaders)
+    sizes = {phase: len(loader.dataset) for phase, loader in loaders.items()}
+    if val_subset is not None and val_subset < sizes['val']:
+        # always the same images, so the epochs can be compared
+        subset = torch.randperm(sizes['val'], generator=torch.Generator().manual_seed(0))[:val_subset]
+        loaders['val'] = torch.utils.data.DataLoader(torch.utils.data.Subset(loaders['val'].dataset, subset.tolist()),
+                                                     batch_size=loaders['val'].batch_size,
+                                                     num_workers=loaders['val'].num_workers)
+        sizes['val'] = val_subset
+
+    if errors is not None:
+        val_loader = loaders['val']
+        val_set = val_loader.dataset
+        if not isinstance(val_loader.sampler, torch.utils.data.SequentialSampler): # the rows have to come in order
+            loaders['val'] = torch.utils.data.DataLoader(val_set, batch_size=val_loader.batch_size,
+                                                         num_workers=val_loader.num_workers)
+        # index of every validation image in the full dataset
+        val_ids = torch.as_tensor(val_set.indices if isinstance(val_set, torch.utils.data.Subset) else range(len(val_set)))
+
+    fingerprint = run_fingerprint(model, optimizer, loaders, run_config)
+    checkpointer = AsyncCheckpointer(checkpoint_dir) if checkpoint_dir else None
+    checkpoint = checkpointer.load() if checkpointer and resume else None
+    if checkpoint is not None:
+        saved = checkpoint.get('fingerprint') or {} # older checkpoints have none
+        changed = [key for key in fingerprint if saved.get(key) != fingerprint[key]]
+        if changed:
+            checkpointer.close()
+            raise ValueError(f"{checkpointer.path} was written by another run ({', '.join(changed)} changed), "
+                             "use another checkpoint_dir or resume=False")
+        # continue exactly where the last run stopped
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        set_rng_states(checkpoint['rng'])
+        best_model_wts = checkpoint['best_model_wts']
+        best_acc = checkpoint['best_acc']
+        start_epoch = checkpoint['epoch'] + 1
+        stopping.load_state_dict(checkpoint.get('stopping', {}))
+        print(f'Resuming from epoch {start_epoch}')
+        if start_epoch >= num_epochs:
+            print(f'The checkpoint already has {start_epoch} epochs, nothing left to train for num_epochs={num_epochs}')
     
-    #training loop
-    for epoch in range(num_epochs):
-        print(f'Epoch {epoch}/{num_epochs - 1}') #prints the current epoch we are in
-        print('-' * 10)
-
-        # Each epoch has a training and validation phase
-        for phase in ['train', 'val']:
-            if phase == 'train':
-                model.train()  # Set model to training mode
-            else:
-                model.eval()   # Set model to evaluate mode
-
-            running_loss = 0.0 #initialize the loss to 0
-            running_corrects = 0 #initialize the number of correct classifications to 0
-
-            # Iterate over data.
-            for inputs, labels in dataloaders[phase]:
-                inputs = inputs.to(device) #copy inputs to GPU
-                labels = labels.to(device) #copy labels to GPU
-
-                # zero the parameter gradients
-                optimizer.zero_grad()
-
-                # forward
-                # track history if only in train
-                with torch.set_grad_enabled(phase == 'train'):
-                    outputs = model(inputs)
-                    _, preds = torch.max(outputs, 1)
-                    loss = criterion(outputs, labels) #crossentropy loss
-
-                    # backward + optimize only if in training phase
-                    if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
-
-                # statistics
-                running_loss += loss.item() * inputs.size(0) #multiply the loss w/ batch size=4
-                running_corrects += torch.sum(preds == labels.data)
-            if phase == 'train':
-                scheduler.step() #used for the model to converge faster
+    try:
+        #training loop
+        for epoch in range(start_epoch, num_epochs):
+            print(f'Epoch {epoch}/{num_epochs - 1}') #prints the current epoch we are in
+            print('-' * 10)
+
+            # Each epoch has a training and (every `val_every` epochs) a validation phase
+            validate = (epoch + 1) % val_every == 0 or epoch == num_epochs - 1
+            for phase in ['train', 'val'] if validate else ['train']:
+                if phase == 'train':
+                    model.train()  # Set model to training mode
+                else:
+                    model.eval()   # Set model to evaluate mode
+
+                running_loss = 0.0 #initialize the loss to 0
+                running_corrects = 0 #initialize the number of correct classifications to 0
+                seen = 0
+
+                # Iterate over data.
+                # the prefetcher already copied inputs and labels to the GPU
+                for inputs, labels in DevicePrefetcher(loaders[phase], device):
+
+                    # zero the parameter gradients
+                    optimizer.zero_grad()
+
+                    # forward
+                    # track history if only in train
+                    with torch.set_grad_enabled(phase == 'train'):
+                        outputs = model(inputs)
+                        _, preds = torch.max(outputs, 1)
+                        loss = criterion(outputs, labels) #crossentropy loss
+
+                        # backward + optimize only if in training phase
+                        if phase == 'train':
+                            loss.backward()
+                            optimizer.step()
+
+                    # statistics
+                    running_loss += loss.item() * inputs.size(0) #multiply the loss w/ batch size=4
+                    running_corrects += torch.sum(preds == labels.data)
+                    if phase == 'val' and errors is not None:
+                        errors.record_logits(epoch, val_ids[seen:seen + len(labels)], labels, outputs)
+                    seen += len(labels)
+                if phase == 'val' and errors is not None:
+                    errors.commit(epoch)
+                if phase == 'train':
+                    scheduler.step() #used for the model to converge faster
             
-            #print loss and accuracy at the end of every epoch
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
-
-            print(f'{phase} Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
-
-            # deep copy the model
-            if phase == 'val' and epoch_acc > best_acc:
-                best_acc = epoch_acc
-                best_model_wts = copy.deepcopy(model.state_dict()) #overwriting the best model
-
-        print()
+                #print loss and accuracy at the end of every epoch
+                epoch_loss = running_loss / sizes[phase]
+                epoch_acc = running_corrects.double() / sizes[phase]
+
+                print(f'{phase} Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
+
+                # deep copy the model
+                if phase == 'val' and epoch_acc > best_acc:
+                    best_acc = epoch_acc
+                    best_model_wts = copy.deepcopy(model.state_dict()) #overwriting the best model
+                if phase == 'val':
+                    stopping.step(epoch_acc.item() if monitor == 'acc' else epoch_loss)
+
+            stop = stopping.should_stop
+            if checkpointer and ((epoch + 1) % checkpoint_every == 0 or epoch == num_epochs - 1 or stop):
+                checkpointer.save({'epoch': epoch, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                                   'scheduler': scheduler.state_dict(), 'rng': rng_states(),
+                                   'best_acc': best_acc, 'best_model_wts': best_model_wts,
+                                   'stopping': stopping.state_dict(), 'fingerprint': fingerprint})
+            print()
+            if stop:
+                print(f'Early stopping: val {monitor} did not improve for {patience} validations')
+                break
+    finally:
+        if checkpointer:
+            checkpointer.close() # waits for the last checkpoint and raises if writing it failed
 
     time_elapsed = time.time() - since
     print(f'Training complete in {time_elapsed // 60:.0f}m {time_elapsed % 60:.0f}s')
@@ -334,30 +605,322 @@ It basically, prints few instances of validation pictures and shows us what pred
 """
 
 def visualize_model(model, num_images=6):
+    import matplotlib.pyplot as plt
     was_training = model.training
     model.eval()
-    images_so_far = 0
-    fig = plt.figure()
+    images, preds = [], []
 
     with torch.no_grad():
-        for i, (inputs, labels) in enumerate(dataloaders['val']):
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-
+        for inputs, labels in DevicePrefetcher(dataloaders['val'], device):
             outputs = model(inputs)
-            _, preds = torch.max(outputs, 1)
+            _, batch_preds = torch.max(outputs, 1)
+            images.append(inputs.cpu())
+            preds += batch_preds.tolist()
+            if len(preds) >= num_images:
+                break
+    model.train(mode=was_training)
+
+    # all the images in one grid and one call to imshow
+    grid = torchvision.utils.make_grid(torch.cat(images)[:num_images], nrow=2)
+    plt.figure()
+    plt.axis('off')
+    imshow(grid, title=', '.join(f'predicted: {class_names[p]}' for p in preds[:num_images]))
+
+"""### Prediction reports
+`visualize_model` is fine for 6 images, but to look at the predictions for the whole validation set (or thousands of images on a server without a display) we don't want a matplotlib figure at all. `PredictionReport` builds the pages directly from the tensors:
+
+- `denormalize` reverts the normalization of the whole batch with one tensor operation.
+- Every image gets a border which is green if the prediction is right and red if it is wrong. The borders are made for the whole batch at once too.
+- Every `per_page` images, `make_grid` puts them together and the page is saved as a PNG with `torchvision.utils.save_image` (only PIL, no plotting backend).
+- With `html_index=True` there is also an `index.html` with all the pages and a table with the prediction, the label and the confidence of every image, in the same order as in the grid.
+"""
 
-            for j in range(inputs.size()[0]):
-                images_so_far += 1
-                ax = plt.subplot(num_images//2, 2, images_so_far)
-                ax.axis('off')
-                ax.set_title(f'predicted: {class_names[preds[j]]}')
-                imshow(inputs.cpu().data[j])
+import html
+
+class PredictionReport:
+    RIGHT = torch.tensor([0.0, 0.8, 0.0])
+    WRONG = torch.tensor([0.9, 0.0, 0.0])
+
+    def __init__(self, out_dir, class_names, nrow=8, per_page=64, border=4, html_index=True):
+        self.out_dir = out_dir
+        self.class_names = class_names
+        self.nrow = nrow
+        self.per_page = per_page
+        self.border = border
+        self.html_index = html_index
+        self.pages = [] # (file name, rows of the table)
+        self._images, self._rows = [], []
+        os.makedirs(out_dir, exist_ok=True)
+
+    def framed(self, images, correct):
+        """The denormalized batch with a green/red border around every image, in one go."""
+        b = self.border
+        images = denormalize(images)
+        n, c, h, w = images.shape
+        colours = torch.where(correct.view(-1, 1), self.RIGHT.to(images.device), self.WRONG.to(images.device))
+        frames = colours.view(n, c, 1, 1).expand(n, c, h + 2 * b, w + 2 * b).clone()
+        frames[:, :, b:b + h, b:b + w] = images
+        return frames
+
+    def add(self, images, labels, outputs):
+        confidence, preds = torch.softmax(outputs, dim=1).max(dim=1)
+        frames = self.framed(images, preds == labels).cpu()
+        rows = list(zip(preds.tolist(), labels.tolist(), confidence.tolist()))
+        while len(frames): # a batch can end one page and start the next one
+            room = self.per_page - len(self._rows)
+            self._images.append(frames[:room])
+            self._rows += rows[:room]
+            frames, rows = frames[room:], rows[room:]
+            if len(self._rows) == self.per_page:
+                self.flush()
+
+    def flush(self):
+        if not self._images:
+            return
+        name = f'page_{len(self.pages):04d}.png'
+        grid = torchvision.utils.make_grid(torch.cat(self._images), nrow=self.nrow, padding=0)
+        torchvision.utils.save_image(grid, os.path.join(self.out_dir, name))
+        self.pages.append((name, self._rows))
+        self._images, self._rows = [], []
+
+    def close(self):
+        self.flush()
+        if self.html_index:
+            self.write_html()
+        return self.pages
+
+    def write_html(self):
+        parts = ['<html><head><meta charset="utf-8"><title>Predictions</title></head><body>']
+        first = 0
+        for name, rows in self.pages:
+            parts.append(f'<h2>Images {first} - {first + len(rows) - 1}</h2><img src="{name}">')
+            parts.append('<table><tr><th>#</th><th>predicted</th><th>label</th><th>confidence</th></tr>')
+            for i, (pred, label, confidence) in enumerate(rows, first):
+                style = '' if pred == label else ' style="color:red"'
+                parts.append(f'<tr{style}><td>{i}</td><td>{html.escape(str(self.class_names[pred]))}</td>'
+                             f'<td>{html.escape(str(self.class_names[label]))}</td><td>{confidence:.3f}</td></tr>')
+            parts.append('</table>')
+            first += len(rows)
+        parts.append('</body></html>')
+        with open(os.path.join(self.out_dir, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(parts))
+
+def prediction_report(model, loader, out_dir, max_images=None, **kwargs):
+    """Writes the predictions of `model` on `loader` as PNG pages (and an index.html) to `out_dir`."""
+    was_training = model.training
+    model.eval()
+    report = PredictionReport(out_dir, class_names, **kwargs)
+    seen = 0
+    with torch.no_grad():
+        for inputs, labels in DevicePrefetcher(loader, device):
+            if max_images is not None:
+                inputs, labels = inputs[:max_images - seen], labels[:max_images - seen]
+            report.add(inputs, labels, model(inputs))
+            seen += len(inputs)
+            if max_images is not None and seen >= max_images:
+                break
+    model.train(mode=was_training)
+    pages = report.close()
+    print(f'{seen} predictions in {len(pages)} pages written to {out_dir}')
+    return pages
+
+"""## Test-time augmentation
+The `val` transform gives the model one center crop of every image. With *test-time augmentation* (TTA) the model also sees a few other views of the image (the mirrored image, the corners, ...) and we combine the results, which usually gives a bit more accuracy for free (no training).
+
+Running the model once per view would make the inference K times slower, so `TTAEngine` does it in one go:
+
+- `get_tta_transform` resizes and crops the images to 256x256 instead of 224x224, so there is room for the other crops. All the images have the same size, so the loader still gives us normal batches.
+- `views` cuts the K views out of the batch with slicing and `torch.flip` (no copy of the images per view in Python) and stacks them into one batch of `K * B` images, so there is a single forward.
+- `reduce` combines the K outputs of every image: `'mean'` averages the logits, `'softmax'` averages the probabilities and `'max'` keeps the most confident view.
+- `budget_ms` caps the latency the extra views may add. The first time it is used, the engine measures how long one more view costs for a batch and keeps only as many views as fit in the budget, in the order of `VIEWS` (the mirrored center first, it helps the most).
+"""
 
-                if images_so_far == num_images:
-                    model.train(mode=was_training)
-                    return
-        model.train(mode=was_training)
+class TTAEngine:
+    VIEWS = ['center', 'flip', 'top_left', 'top_right', 'bottom_left', 'bottom_right',
+             'flip_top_left', 'flip_top_right', 'flip_bottom_left', 'flip_bottom_right']
+    REDUCTIONS = ('mean', 'softmax', 'max')
+
+    def __init__(self, model, views=None, crop=224, reduce='mean', budget_ms=None):
+        if reduce not in self.REDUCTIONS:
+            raise ValueError(f'reduce must be one of {self.REDUCTIONS}')
+        views = list(self.VIEWS if views is None else views)
+        unknown = set(views) - set(self.VIEWS)
+        if unknown:
+            raise ValueError(f'unknown views: {sorted(unknown)}')
+        self.model = model
+        self.views = views
+        self.crop = crop
+        self.reduce = reduce
+        self.budget_ms = budget_ms
+        self.calibrated = budget_ms is None
+
+    def _crop(self, images, name):
+        h, w = images.shape[-2:]
+        c = self.crop
+        top = {'center': (h - c) // 2, 'top': 0, 'bottom': h - c}
+        left = {'center': (w - c) // 2, 'left': 0, 'right': w - c}
+        name = name.replace('flip_', '').replace('flip', 'center')
+        y, x = ('center', 'center') if name == 'center' else name.split('_')
+        return images[..., top[y]:top[y] + c, left[x]:left[x] + c]
+
+    def views_of(self, images, views=None):
+        """[B, C, H, W] -> [K * B, C, crop, crop], view by view."""
+        crops = []
+        for name in self.views if views is None else views:
+            crop = self._crop(images, name)
+            crops.append(torch.flip(crop, dims=[-1]) if name.startswith('flip') else crop)
+        return torch.cat(crops)
+
+    def _reduce(self, outputs, k):
+        outputs = outputs.view(k, -1, outputs.shape[-1]) # [K, B, classes]
+        if self.reduce == 'mean':
+            return outputs.mean(dim=0)
+        probs = torch.softmax(outputs, dim=2)
+        if self.reduce == 'softmax':
+            return probs.mean(dim=0).log() # log-probabilities, so argmax and cross entropy still work
+        best = probs.max(dim=2).values.argmax(dim=0) # the most confident view of every image
+        return outputs[best, torch.arange(outputs.shape[1], device=outputs.device)]
+
+    def _time_ms(self, images, views, repeat=3):
+        def sync():
+            if images.is_cuda:
+                torch.cuda.synchronize(images.device)
+        self.model(self.views_of(images, views)) # warm up
+        sync()
+        since = time.perf_counter()
+        for _ in range(repeat):
+            self.model(self.views_of(images, views))
+        sync()
+        return (time.perf_counter() - since) / repeat * 1000
+
+    @torch.no_grad()
+    def calibrate(self, images):
+        """Keeps only the views that fit in `budget_ms` for a batch like `images`."""
+        was_training = self.model.training
+        self.model.eval()
+        if len(self.views) > 1:
+            one = self._time_ms(images, self.views[:1])
+            per_view = max((self._time_ms(images, self.views) - one) / (len(self.views) - 1), 1e-6)
+            self.views = self.views[:1 + int(self.budget_ms // per_view)]
+            print(f'TTA: {per_view:.1f}ms per extra view, using {len(self.views)} views: {self.views}')
+        self.model.train(mode=was_training)
+        self.calibrated = True
+
+    @torch.no_grad()
+    def __call__(self, images):
+        was_training = self.model.training
+        self.model.eval()
+        if not self.calibrated:
+            self.calibrate(images)
+        outputs = self.model(self.views_of(images)) # one forward for all the views
+        self.model.train(mode=was_training)
+        return self._reduce(outputs, len(self.views))
+
+def get_tta_transform(size=256):
+    transforms = torchvision.transforms
+    return transforms.Compose([
+        transforms.Resize(size),
+        transforms.CenterCrop(size), # square, and bigger than the crops of the views
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+def tta_accuracy(model, data_dir=data_dir, batch_size=16, **kwargs):
+    """The validation accuracy with the center crop only and with TTA, from the same batches."""
+    val_set = torchvision.datasets.ImageFolder(os.path.join(data_dir, 'val'), get_tta_transform())
+    loader = torch.utils.data.DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers=4)
+    engine = TTAEngine(model, **kwargs)
+    center = TTAEngine(model, views=['center'])
+    correct = {'center': 0, 'tta': 0}
+    since = {'center': 0.0, 'tta': 0.0}
+    if not engine.calibrated: # outside of the timed loop, so the ms per batch is only the inference
+        engine.calibrate(next(iter(loader))[0].to(device))
+    for inputs, labels in DevicePrefetcher(loader, device):
+        for name, run in [('center', center), ('tta', engine)]:
+            start = time.perf_counter()
+            preds = run(inputs).argmax(dim=1)
+            since[name] += time.perf_counter() - start
+            correct[name] += (preds == labels).sum().item()
+    for name in correct:
+        print(f'{name:<8} acc {correct[name] / len(val_set):.4f}  {since[name] * 1000 / len(loader):.1f}ms per batch')
+    return {name: correct[name] / len(val_set) for name in correct}
+
+"""## Loading the pretrained weights once
+Every `models.resnet18(pretrained=True)` reads the whole checkpoint again and allocates new memory for it, and below we need the pretrained ResNet18 several times. `ModelRegistry` loads every checkpoint only once:
+
+- The weights file is opened with `torch.load(..., mmap=True)`: it is memory-mapped instead of read, so only the pages that are used get loaded, and the processes that use the same file share them.
+- `get(name)` builds the architecture on the `meta` device (no memory, no random initialization) and then `load_state_dict(..., assign=True)` makes it use the cached tensors directly. So all the models from the registry share the same weights.
+- Sharing is fine as long as nobody writes to the weights. Before training a model, call `unshare(model)` to give it its own copy of the trainable parameters (*copy on write*). Use `buffers=True` if it will be trained in `train()` mode, because BatchNorm updates its running statistics in place. Moving a model to the GPU makes a copy anyway.
+- The registry keeps at most `budget_mb` of weights. When it needs more, it forgets the least recently used checkpoint (LRU). Models that are still using it keep it alive; it just has to be loaded again next time.
+"""
+
+import collections
+import functools
+
+def weights_url(arch):
+    models = torchvision.models
+    enum = getattr(models, f'{arch.replace("resnet", "ResNet")}_Weights', None)
+    if enum is not None:
+        return enum.IMAGENET1K_V1.url
+    return models.resnet.model_urls[arch] # older torchvision
+
+def architecture(arch):
+    return lambda: getattr(torchvision.models, arch)()
+
+class ModelRegistry:
+    def __init__(self, budget_mb=1024):
+        self.budget = budget_mb * 1e6
+        self.builders = {}
+        self.cache = collections.OrderedDict() # name -> state_dict, the last one is the most recently used
+
+    def register(self, name, builder, url):
+        """`url` can also be a function, so that nothing has to be imported until the model is used."""
+        self.builders[name] = (builder, url)
+
+    def _path(self, url):
+        path = os.path.join(torch.hub.get_dir(), 'checkpoints', os.path.basename(url))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            torch.hub.download_url_to_file(url, path)
+        return path
+
+    def state_dict(self, name):
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            return self.cache[name]
+        _, url = self.builders[name]
+        url = url() if callable(url) else url
+        state = torch.load(self._path(url), map_location='cpu', mmap=True, weights_only=True)
+        self.cache[name] = state
+        while len(self.cache) > 1 and self.used_bytes() > self.budget:
+            self.cache.popitem(last=False) # least recently used
+        return state
+
+    def used_bytes(self):
+        return sum(t.numel() * t.element_size() for state in self.cache.values() for t in state.values())
+
+    def get(self, name):
+        builder, _ = self.builders[name]
+        with torch.device('meta'):
+            model = builder()
+        model.load_state_dict(self.state_dict(name), assign=True)
+        return model
+
+def unshare(model, buffers=False):
+    """Give the model its own copy of its trainable parameters (and buffers) before they are changed."""
+    with torch.no_grad():
+        for module in model.modules():
+            for name, param in module.named_parameters(recurse=False):
+                if param.requires_grad:
+                    setattr(module, name, nn.Parameter(param.detach().clone()))
+            if buffers:
+                for name, buffer in module.named_buffers(recurse=False):
+                    setattr(module, name, buffer.clone())
+    return model
+
+registry = ModelRegistry()
+for arch in ['resnet18', 'resnet34', 'resnet50']:
+    registry.register(arch, architecture(arch), functools.partial(weights_url, arch))
 
 """## ResNet18 Architectutre
  Here I wanna check the initial architecture of the ResNet18 trained on the ImageNet dataset.
@@ -371,13 +934,14 @@ that takes 512 features and the output is the 1000 categories of the ImageNet.
 <img title="ResNet18" alt="ResNet18" src="/content/drive/MyDrive/Colab Notebooks/ResNet-18-Architecture.png">
 """
 
-models.resnet18(pretrained=True)
+def show_architecture():
+    print(registry.get('resnet18'))
 
 """## Finetuning the convnet
 
 We use the model ResNet18 and finetune it on our dataset.
 
-- *model_ft = models.resnet18(pretrained=True)*
+- *model_ft = registry.get('resnet18')*
 
   Take the pretrained model and not just the architecture. It was trained on the ImageNet dataset.
 
@@ -386,24 +950,25 @@ We use the model ResNet18 and finetune it on our dataset.
   Here we will map from `num_ftrs` which is equal to 512 to 2 categories of ants and bees. It replaces the previous architecture. Alternatively, it can be generalized to nn.Linear(num_ftrs, len(class_names)).
 """
 
-model_ft = models.resnet18(pretrained=True)
-num_ftrs = model_ft.fc.in_features #number of features in the FC layer
+def get_model_ft():
+    model_ft = unshare(registry.get('resnet18'), buffers=True) # all the weights will be trained
+    num_ftrs = model_ft.fc.in_features #number of features in the FC layer
+    print(num_ftrs) #Just to see :)
 
-#Model's FC layer
-model_ft.fc = nn.Linear(num_ftrs, 2)
+    #Model's FC layer
+    model_ft.fc = nn.Linear(num_ftrs, 2)
 
-#Copy the model to GPU
-model_ft = model_ft.to(device)
+    #Copy the model to GPU
+    model_ft = model_ft.to(device)
 
-criterion = nn.CrossEntropyLoss()
+    criterion = nn.CrossEntropyLoss()
 
-# Observe that all parameters are being optimized
-optimizer_ft = optim.SGD(model_ft.parameters(), lr=0.001, momentum=0.9)
+    # Observe that all parameters are being optimized
+    optimizer_ft = optim.SGD(model_ft.parameters(), lr=0.001, momentum=0.9)
 
-# Decay LR by a factor of 0.1 every 7 epochs
-exp_lr_scheduler = lr_scheduler.StepLR(optimizer_ft, step_size=7, gamma=0.1)
-
-num_ftrs #Just to see :)
+    # Decay LR by a factor of 0.1 every 7 epochs
+    exp_lr_scheduler = lr_scheduler.StepLR(optimizer_ft, step_size=7, gamma=0.1)
+    return model_ft, criterion, optimizer_ft, exp_lr_scheduler
 
 """## Train and evaluate
 It should take around 15-25 min on CPU. On GPU though, it takes less than a minute.
@@ -411,10 +976,22 @@ It should take around 15-25 min on CPU. On GPU though, it takes less than a minu
 The best validation accuracy will display at the result and you can check where exactly it is the case.
 """
 
-model_ft = train_model(model_ft, criterion, optimizer_ft, exp_lr_scheduler,
-                       num_epochs=25)
-
-visualize_model(model_ft) #visualizing some of the results
+def run_finetuning(num_epochs=25, errors_dir=None, resume=False):
+    model_ft, criterion, optimizer_ft, exp_lr_scheduler = get_model_ft()
+    errors = None
+    if errors_dir is not None:
+        errors = ErrorIndex(errors_dir, paths=[path for path, _ in image_datasets['val'].samples],
+                            class_names=class_names, resume=resume)
+    model_ft = train_model(model_ft, criterion, optimizer_ft, exp_lr_scheduler,
+                           num_epochs=num_epochs, checkpoint_dir='checkpoints/model_ft', patience=5, errors=errors,
+                           resume=resume)
+    if errors is not None:
+        print('Most frequent mistakes:', errors.confusion_pairs(k=5))
+        for row in errors.hardest(5, wrong_only=True):
+            print(row)
+
+    visualize_model(model_ft) #visualizing some of the results
+    return model_ft
 
 """## ConvNet as fixed feature extractor
 
@@ -425,24 +1002,29 @@ We will just train the fully connected layer of the model and leave the base mod
 Training in this case on CPU wouldn't take as much time as needed for finetuning. Feature extractor is faster since you only have to compute the forward path and no backward step since you don't have to change all the weights in the ResNet.
 """
 
-model_conv = torchvision.models.resnet18(pretrained=True)
-for param in model_conv.parameters():
-    param.requires_grad = False
+def get_model_conv():
+    model_conv = registry.get('resnet18')
+    for param in model_conv.parameters():
+        param.requires_grad = False
+    # frozen first: then unshare only copies the BatchNorm statistics (they change in train mode),
+    # and the weights stay shared with the registry
+    unshare(model_conv, buffers=True)
 
-# Parameters of newly constructed modules have requires_grad=True by default
-num_ftrs = model_conv.fc.in_features
-model_conv.fc = nn.Linear(num_ftrs, 2)
+    # Parameters of newly constructed modules have requires_grad=True by default
+    num_ftrs = model_conv.fc.in_features
+    model_conv.fc = nn.Linear(num_ftrs, 2)
 
-model_conv = model_conv.to(device)
+    model_conv = model_conv.to(device)
 
-criterion = nn.CrossEntropyLoss()
+    criterion = nn.CrossEntropyLoss()
 
-# Observe that only parameters of final layer are being optimized as
-# opposed to before.
-optimizer_conv = optim.SGD(model_conv.fc.parameters(), lr=0.001, momentum=0.9)
+    # Observe that only parameters of final layer are being optimized as
+    # opposed to before.
+    optimizer_conv = optim.SGD(model_conv.fc.parameters(), lr=0.001, momentum=0.9)
 
-# Decay LR by a factor of 0.1 every 7 epochs
-exp_lr_scheduler = lr_scheduler.StepLR(optimizer_conv, step_size=7, gamma=0.1)
+    # Decay LR by a factor of 0.1 every 7 epochs
+    exp_lr_scheduler = lr_scheduler.StepLR(optimizer_conv, step_size=7, gamma=0.1)
+    return model_conv, criterion, optimizer_conv, exp_lr_scheduler
 
 """## Train and evaluate
 
@@ -451,10 +1033,497 @@ It performs better than the finetuning. It might be the case because the dataset
 Generally, If you have a large dataset like 1000-5000 images finetuning would be a better option. 
 """
 
-model_conv = train_model(model_conv, criterion, optimizer_conv,
-                         exp_lr_scheduler, num_epochs=25)
+def run_feature_extractor(num_epochs=25, resume=False):
+    model_conv, criterion, optimizer_conv, exp_lr_scheduler = get_model_conv()
+    model_conv = train_model(model_conv, criterion, optimizer_conv,
+                             exp_lr_scheduler, num_epochs=num_epochs, checkpoint_dir='checkpoints/model_conv', patience=5,
+                             resume=resume)
+
+    visualize_model(model_conv)
+    return model_conv
+
+"""## Making the model faster for production
+`model_ft` is a plain fp32 ResNet18. For serving on CPUs we can make it a lot cheaper, in three steps:
 
-visualize_model(model_conv)
+- ### BatchNorm folding
+  In evaluation mode a BatchNorm layer is just a fixed scale and shift per channel, so it can be merged into the weights of the convolution right before it. `fuse_model()` of the quantizable ResNet18 does that (and also merges the ReLU), so there is one layer less to run and the result is the same.
+- ### Post-training static quantization
+  Weights and activations are stored as 8 bit integers instead of 32 bit floats. *Static* means that the ranges of the activations are measured once, by running a few batches of the `val` images through the model (calibration), instead of at every forward.
+- ### Structured pruning (optional)
+  Inside every residual block we remove the `amount` fraction of the channels of `conv1` with the smallest weights (L1 norm). The channels are really removed (from `conv1`, `bn1` and the input of `conv2`), so the model gets smaller and faster, not just sparse. It usually costs some accuracy, more training would win it back.
+
+`export_variants` builds all the variants and prints their accuracy (and the difference to fp32), latency for one image and throughput for a batch on the CPU.
+"""
+
+import io
+import torch.ao.quantization as tq
+
+def to_quantizable(model):
+    """A quantizable ResNet18 (with QuantStub/DeQuantStub) with the weights of `model`."""
+    qmodel = torchvision.models.quantization.resnet18(pretrained=False, quantize=False)
+    qmodel.fc = nn.Linear(qmodel.fc.in_features, model.fc.out_features)
+    qmodel.load_state_dict(model.state_dict())
+    return qmodel.cpu().eval()
+
+def prune_channels(model, amount=0.3):
+    for block in model.modules():
+        if not isinstance(block, torchvision.models.resnet.BasicBlock):
+            continue
+        weight = block.conv1.weight.detach()
+        n_keep = max(1, int(round(weight.shape[0] * (1 - amount))))
+        keep = weight.abs().sum(dim=(1, 2, 3)).argsort(descending=True)[:n_keep].sort().values
+        conv1 = nn.Conv2d(block.conv1.in_channels, n_keep, 3, stride=block.conv1.stride, padding=1, bias=False)
+        conv1.weight.data = weight[keep].clone()
+        bn1 = nn.BatchNorm2d(n_keep)
+        for name in ['weight', 'bias', 'running_mean', 'running_var']:
+            getattr(bn1, name).data = getattr(block.bn1, name).detach()[keep].clone()
+        conv2 = nn.Conv2d(n_keep, block.conv2.out_channels, 3, stride=1, padding=1, bias=False)
+        conv2.weight.data = block.conv2.weight.detach()[:, keep].clone()
+        block.conv1, block.bn1, block.conv2 = conv1, bn1, conv2
+    return model.eval()
+
+def quantize_static(model, calibration_loader, num_batches=10):
+    model = copy.deepcopy(model).eval()
+    model.fuse_model()
+    model.qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    tq.prepare(model, inplace=True)
+    with torch.no_grad(): # calibration: just run some images through it
+        for i, (inputs, _) in enumerate(calibration_loader):
+            if i == num_batches:
+                break
+            model(inputs)
+    return tq.convert(model)
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1e6
+
+@torch.no_grad()
+def measure(model, loader, batch_size=32, n_runs=20):
+    model.eval()
+    correct = total = 0
+    for inputs, labels in loader:
+        correct += (model(inputs).argmax(dim=1) == labels).sum().item()
+        total += labels.size(0)
+    timings = {}
+    for n in (1, batch_size):
+        x = torch.randn(n, 3, 224, 224)
+        for _ in range(3): # warm up
+            model(x)
+        since = time.perf_counter()
+        for _ in range(n_runs):
+            model(x)
+        timings[n] = (time.perf_counter() - since) / n_runs
+    return {'acc': correct / total, 'latency_ms': timings[1] * 1000,
+            'throughput': batch_size / timings[batch_size], 'size_mb': model_size_mb(model)}
+
+def export_variants(model, val_loader, prune_amount=None, out_dir='.'):
+    fp32 = to_quantizable(model)
+    folded = copy.deepcopy(fp32)
+    folded.fuse_model()
+    variants = {'fp32': fp32, 'fp32 + BN folded': folded, 'int8': quantize_static(fp32, val_loader)}
+    if prune_amount:
+        pruned = prune_channels(copy.deepcopy(fp32), prune_amount)
+        variants[f'pruned {prune_amount:.0%} + int8'] = quantize_static(pruned, val_loader)
+
+    report = {name: measure(m, val_loader) for name, m in variants.items()}
+    base = report['fp32']['acc']
+    print(f"{'variant':<22}{'acc':>8}{'delta':>8}{'latency':>12}{'img/s':>9}{'MB':>7}")
+    for name, r in report.items():
+        print(f"{name:<22}{r['acc']:8.4f}{r['acc'] - base:+8.4f}{r['latency_ms']:10.1f}ms{r['throughput']:9.1f}{r['size_mb']:7.1f}")
+    # TorchScript files that can be loaded without this code
+    for name, m in variants.items():
+        path = os.path.join(out_dir, 'resnet18_' + name.replace(' ', '').replace('+', '_').replace('%', '') + '.pt')
+        torch.jit.save(torch.jit.trace(m, torch.randn(1, 3, 224, 224)), path)
+    return variants, report
+
+"""Quantized models only run on the CPU, so we use a CPU copy of the model and a val loader without shuffling."""
+
+def run_export(model_ft, prune_amount=0.3):
+    val_loader = torch.utils.data.DataLoader(image_datasets['val'], batch_size=32, shuffle=False, num_workers=4)
+    return export_variants(copy.deepcopy(model_ft).cpu(), val_loader, prune_amount=prune_amount)
+
+"""## Knowledge distillation
+For the edge devices even the int8 ResNet18 is too slow. Instead we train the tiny 3-conv `Net` from the Intro tutorial (`CreatingConvNetIntro`) as a *student* that learns to copy `model_ft`, the *teacher*. `StudentNet` imports it from `Intro/creatingconvnetintro.py` and only changes the number of classes and returns the logits instead of the softmax (in Colab, upload that file as `Intro/creatingconvnetintro.py` next to the notebook too):
+
+- The loss is a mix of the usual cross entropy with the labels (*hard* targets) and the KL divergence between the softened outputs of the student and of the teacher (*soft* targets, softmax with temperature `T`). The soft targets also say *how* sure the teacher is, which is more information than just the label. `alpha` is the weight of the soft part; the `T**2` keeps its gradients at the same scale as the hard part.
+- The teacher is only needed for its outputs, and they don't change. So `cache_distillation_data` runs the teacher **once** over the images (with the deterministic `val` transform) and saves its logits together with the student inputs (grayscale 50x50, like in the Intro tutorial) in a file. The file also keeps a hash of the teacher's weights (`state_hash`) and the image folder, so if `model_ft` is trained again the logits are computed again instead of using the old ones. After that an epoch of the student doesn't touch the teacher or the image files at all.
+"""
+
+import torch.nn.functional as F
+
+from Intro.creatingconvnetintro import Net # the root of the repo is in sys.path already, see trainingtools
+
+class StudentNet(Net):
+    """The Net of CreatingConvNetIntro, returning logits instead of softmax."""
+    def __init__(self, num_classes=2):
+        super().__init__()
+        self.fc2 = nn.Linear(self.fc2.in_features, num_classes)
+
+    def convs(self, x): # the same as in Net, but without printing the shape for every batch
+        for conv in (self.conv1, self.conv2, self.conv3):
+            x = F.max_pool2d(F.relu(conv(x)), (2, 2))
+        if self._to_linear is None:
+            self._to_linear = x[0].numel()
+        return x
+
+    def forward(self, x):
+        x = self.convs(x).view(-1, self._to_linear)
+        return self.fc2(F.relu(self.fc1(x)))
+
+def get_student_transform():
+    transforms = torchvision.transforms
+    return transforms.Compose([
+        transforms.Grayscale(),
+        transforms.Resize(56),
+        transforms.CenterCrop(50),
+        transforms.ToTensor(),
+    ])
+
+def state_hash(model):
+    """A hash of all the weights and buffers of `model`, to know which model a cache was made with."""
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+@torch.no_grad()
+def cache_distillation_data(teacher, phase, path, data_dir=data_dir, batch_size=32):
+    key = {'teacher': state_hash(teacher), 'data': os.path.abspath(os.path.join(data_dir, phase))}
+    if os.path.exists(path):
+        cache = torch.load(path)
+        if cache.get('key') == key:
+            return cache
+        print(f'{path} was made with another teacher or other images, computing it again')
+    teacher.eval()
+    # same files in the same order (ImageFolder sorts them), with the teacher's and the student's transform
+    teacher_set = torchvision.datasets.ImageFolder(os.path.join(data_dir, phase), get_data_transforms()['val'])
+    student_set = torchvision.datasets.ImageFolder(os.path.join(data_dir, phase), get_student_transform())
+    loader = torch.utils.data.DataLoader(teacher_set, batch_size=batch_size, shuffle=False, num_workers=4)
+    logits = torch.cat([teacher(inputs.to(device)).cpu() for inputs, _ in loader])
+    inputs = torch.stack([student_set[i][0] for i in range(len(student_set))])
+    labels = torch.tensor(student_set.targets)
+    cache = {'inputs': inputs, 'labels': labels, 'teacher_logits': logits, 'key': key}
+    torch.save(cache, path)
+    return cache
+
+def distillation_loss(student_logits, teacher_logits, labels, T=4.0, alpha=0.7):
+    soft = F.kl_div(F.log_softmax(student_logits / T, dim=1), F.softmax(teacher_logits / T, dim=1),
+                    reduction='batchmean') * T * T
+    hard = F.cross_entropy(student_logits, labels)
+    return alpha * soft + (1 - alpha) * hard
+
+def train_student(student, train_cache, val_cache, num_epochs=30, batch_size=32, lr=0.001, T=4.0, alpha=0.7):
+    student = student.to(device)
+    optimizer = optim.Adam(student.parameters(), lr=lr)
+    inputs, labels, logits = (train_cache[k].to(device) for k in ('inputs', 'labels', 'teacher_logits'))
+    best_acc, best_wts = 0.0, copy.deepcopy(student.state_dict())
+    for epoch in range(num_epochs):
+        student.train()
+        order = torch.randperm(len(labels), device=device)
+        for i in range(0, len(order), batch_size):
+            idx = order[i:i + batch_size]
+            optimizer.zero_grad()
+            loss = distillation_loss(student(inputs[idx]), logits[idx], labels[idx], T, alpha)
+            loss.backward()
+            optimizer.step()
+        acc = cached_accuracy(student, val_cache['inputs'], val_cache['labels'])
+        print(f'Epoch {epoch}/{num_epochs - 1} loss: {loss.item():.4f} val Acc: {acc:.4f}')
+        if acc > best_acc:
+            best_acc, best_wts = acc, copy.deepcopy(student.state_dict())
+    student.load_state_dict(best_wts)
+    return student
+
+@torch.no_grad()
+def cached_accuracy(model, inputs, labels, batch_size=64):
+    model.eval()
+    correct = 0
+    for i in range(0, len(labels), batch_size):
+        preds = model(inputs[i:i + batch_size].to(device)).argmax(dim=1)
+        correct += (preds.cpu() == labels[i:i + batch_size].cpu()).sum().item()
+    return correct / len(labels)
+
+@torch.no_grad()
+def cpu_latency_ms(model, input_shape, n_runs=50):
+    model = copy.deepcopy(model).cpu().eval()
+    x = torch.randn(*input_shape)
+    for _ in range(5):
+        model(x)
+    since = time.perf_counter()
+    for _ in range(n_runs):
+        model(x)
+    return (time.perf_counter() - since) / n_runs * 1000
+
+def run_distillation(model_ft, data_dir=data_dir):
+    train_cache = cache_distillation_data(model_ft, 'train', 'distill_train.pt', data_dir)
+    val_cache = cache_distillation_data(model_ft, 'val', 'distill_val.pt', data_dir)
+    student = train_student(StudentNet(num_classes=len(class_names)), train_cache, val_cache)
+    compare_student(model_ft, student, val_cache)
+    return student
+
+"""### Teacher vs. student
+The teacher's accuracy comes from the cached logits, so we don't have to run it again."""
+
+def compare_student(model_ft, student, val_cache):
+    teacher_acc = (val_cache['teacher_logits'].argmax(dim=1) == val_cache['labels']).float().mean().item()
+    student_acc = cached_accuracy(student, val_cache['inputs'], val_cache['labels'])
+    print(f"{'model':<10}{'acc':>8}{'CPU latency':>14}{'params':>12}")
+    for name, model, shape, acc in [('teacher', model_ft, (1, 3, 224, 224), teacher_acc),
+                                    ('student', student, (1, 1, 50, 50), student_acc)]:
+        n_params = sum(p.numel() for p in model.parameters())
+        print(f"{name:<10}{acc:8.4f}{cpu_latency_ms(model, shape):12.2f}ms{n_params:12,}")
+
+"""## Hyperparameter sweeps
+Instead of trying the configurations by hand one after another, `sweep` tries many of them in parallel and stops the bad ones early (*successive halving*):
+
+1. `n_trials` random configurations are drawn from the search space (`lr`, `step_size`, `gamma`, number of `frozen` ResNet stages, `batch_size`).
+2. All of them are trained for `min_epochs` epochs. Only the best `1/eta` of them (by val accuracy) go on to the next round, which has `eta` times more epochs, and so on up to `max_epochs`.
+3. A trial continues from its own checkpoint (see `train_model(checkpoint_dir=...)`), so the epochs of a round are not trained again.
+
+The checkpoints of a sweep go to their own folder in `out_dir`, named after a hash of the search space, `n_trials` and `seed`. So running the same sweep again continues it, and another sweep never finds the checkpoints of an old one. The configuration of the trial is also given to `train_model` as `run_config`, so a checkpoint of another configuration is refused instead of being continued.
+
+The trials run on a pool of `n_workers` processes. Every worker gets its own set of CPU cores (`os.sched_setaffinity`) and uses only as many threads (`torch.set_num_threads`), otherwise all the trials would fight for all the cores. The trials always run on the CPU, even on a GPU machine: a forked worker can't use CUDA once the parent has started it (e.g. by finetuning before the sweep), and the cores are what the workers are split by. Every worker loads the datasets from `data_dir` when it starts, so it doesn't matter if the processes are forked or spawned. The pool processes can't start DataLoader workers, so the trials load the batches in the process itself. All the results are written to `results_csv`.
+"""
+
+import csv
+import itertools
+import json
+import multiprocessing as mp
+
+SEARCH_SPACE = {
+    'lr': [0.0003, 0.001, 0.003, 0.01],
+    'step_size': [3, 7, 10],
+    'gamma': [0.1, 0.3],
+    'frozen': [0, 2, 4, 5], # 5 = everything but fc, like model_conv
+    'batch_size': [4, 8, 16],
+}
+
+def sample_configs(space, n_trials, seed=0):
+    rng = random.Random(seed)
+    return [dict({k: rng.choice(v) for k, v in space.items()}, seed=seed + i) for i in range(n_trials)]
+
+def freeze_stages(model, n):
+    """Freeze the first n of the 5 stages of a ResNet (stem, layer1, ..., layer4)."""
+    stages = [[model.conv1, model.bn1], [model.layer1], [model.layer2], [model.layer3], [model.layer4]]
+    for stage in stages[:n]:
+        for module in stage:
+            for param in module.parameters():
+                param.requires_grad = False
+    return model
+
+def _pin_worker(core_groups, data_dir):
+    global device, image_datasets, class_names
+    cores = core_groups.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    # a forked worker can't use the CUDA of its parent, and the cores are what the trials are pinned to anyway
+    device = torch.device('cpu')
+    # with spawn nothing is inherited, so every worker loads the data itself
+    image_datasets = make_datasets(data_dir)
+    class_names = image_datasets['train'].classes
+
+def run_trial(job):
+    trial, config, num_epochs, trial_dir = job
+    torch.manual_seed(config['seed'])
+    model = registry.get('resnet18')
+    model.fc = nn.Linear(model.fc.in_features, len(class_names))
+    unshare(freeze_stages(model, config['frozen']), buffers=True).to(device)
+    loaders = {x: torch.utils.data.DataLoader(image_datasets[x], batch_size=config['batch_size'],
+                                              shuffle=x == 'train', num_workers=0)
+               for x in ['train', 'val']}
+    optimizer = optim.SGD([p for p in model.parameters() if p.requires_grad], lr=config['lr'], momentum=0.9)
+    scheduler = lr_scheduler.StepLR(optimizer, step_size=config['step_size'], gamma=config['gamma'])
+    since = time.time()
+    train_model(model, nn.CrossEntropyLoss(), optimizer, scheduler, num_epochs=num_epochs,
+                checkpoint_dir=trial_dir, loaders=loaders, run_config=dict(config, trial=trial))
+    best_acc = float(torch.load(os.path.join(trial_dir, 'last.pt'), map_location='cpu', weights_only=False)['best_acc'])
+    return trial, best_acc, time.time() - since
+
+def sweep(space=SEARCH_SPACE, n_trials=27, min_epochs=1, max_epochs=25, eta=3, n_workers=None,
+          threads_per_trial=None, out_dir='sweep', results_csv='sweep_results.csv', seed=0, data_dir=data_dir):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    threads_per_trial = threads_per_trial or max(1, len(cores) // (n_workers or 4))
+    n_workers = n_workers or max(1, len(cores) // threads_per_trial)
+    core_groups = mp.Queue()
+    for i in range(n_workers):
+        core_groups.put(cores[(i * threads_per_trial) % len(cores):][:threads_per_trial])
+
+    configs = sample_configs(space, n_trials, seed)
+    sweep_id = hashlib.sha1(json.dumps([space, n_trials, seed], sort_keys=True).encode()).hexdigest()[:12]
+    sweep_dir = os.path.join(out_dir, sweep_id) # one folder per sweep, so old checkpoints are never picked up
+    print(f'Sweep checkpoints in {sweep_dir}')
+    alive = list(range(n_trials))
+    rows = []
+    with mp.Pool(n_workers, initializer=_pin_worker, initargs=(core_groups, data_dir)) as pool:
+        for rung in itertools.count():
+            epochs = min(min_epochs * eta ** rung, max_epochs)
+            jobs = [(t, configs[t], epochs, os.path.join(sweep_dir, f'trial_{t:03d}')) for t in alive]
+            results = {t: (acc, seconds) for t, acc, seconds in pool.imap_unordered(run_trial, jobs)}
+            for t in alive:
+                rows.append(dict(configs[t], trial=t, rung=rung, epochs=epochs, val_acc=results[t][0], seconds=results[t][1]))
+            print(f'Rung {rung}: {len(alive)} trials x {epochs} epochs, best val Acc {max(r[0] for r in results.values()):.4f}')
+            if epochs >= max_epochs or len(alive) == 1:
+                break
+            alive = sorted(alive, key=lambda t: results[t][0], reverse=True)[:max(1, len(alive) // eta)]
+
+    with open(results_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['trial', 'rung', 'epochs', 'val_acc', 'seconds'] + list(space) + ['seed'])
+        writer.writeheader()
+        writer.writerows(rows)
+    best = max((r for r in rows if r['rung'] == rows[-1]['rung']), key=lambda r: r['val_acc'])
+    print('Best configuration:', {k: best[k] for k in space}, f"val Acc {best['val_acc']:.4f}")
+    return rows
+
+"""## Progressive unfreezing
+Finetuning (`model_ft`) and the fixed feature extractor (`model_conv`) are the two extremes. In between, we can start like the feature extractor and unfreeze the ResNet stages one by one from the top (`layer4`, then `layer3`, ...), while training:
+
+- Every stage gets its own learning rate (*discriminative learning rates*): `fc` gets `lr`, `layer4` gets `lr * decay`, `layer3` `lr * decay**2` and so on. The lower layers have more general features, so they should change less.
+- `ProgressiveResNet` runs the frozen stages under `torch.no_grad()`. Autograd doesn't record anything before the first trainable stage, so backward stops there and the activations of the frozen stages are not kept. The BatchNorms of the frozen stages stay in eval mode too. So the first epochs cost about as much as the feature extractor.
+- `ProgressiveUnfreezing` wraps the learning rate scheduler. `train_model` calls `scheduler.step()` after every epoch, and every `every` epochs it also unfreezes the next stage. Its `state_dict` keeps the epoch, so it works with the checkpoints as well.
+"""
+
+class ProgressiveResNet(nn.Module):
+    STAGES = ['stem', 'layer1', 'layer2', 'layer3', 'layer4']
+
+    def __init__(self, resnet, num_classes):
+        super().__init__()
+        self.stem = nn.Sequential(resnet.conv1, resnet.bn1, resnet.relu, resnet.maxpool)
+        self.layer1, self.layer2, self.layer3, self.layer4 = resnet.layer1, resnet.layer2, resnet.layer3, resnet.layer4
+        self.avgpool = resnet.avgpool
+        self.fc = nn.Linear(resnet.fc.in_features, num_classes)
+        self.set_frozen(len(self.STAGES)) # start as a fixed feature extractor
+
+    def set_frozen(self, n):
+        """Freeze the first n stages and unfreeze the others."""
+        self.n_frozen = n
+        for i, name in enumerate(self.STAGES):
+            for param in getattr(self, name).parameters():
+                param.requires_grad = i >= n
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        for name in self.STAGES[:self.n_frozen]:
+            getattr(self, name).eval() # frozen BatchNorms keep their statistics
+        return self
+
+    def forward(self, x):
+        stages = [getattr(self, name) for name in self.STAGES]
+        with torch.no_grad(): # nothing to learn here, so no graph for backward
+            for stage in stages[:self.n_frozen]:
+                x = stage(x)
+        for stage in stages[self.n_frozen:]:
+            x = stage(x)
+        x = torch.flatten(self.avgpool(x), 1)
+        return self.fc(x)
+
+    def param_groups(self, lr, decay=0.3):
+        groups = [{'params': self.fc.parameters(), 'lr': lr}]
+        for depth, name in enumerate(reversed(self.STAGES), start=1):
+            groups.append({'params': getattr(self, name).parameters(), 'lr': lr * decay ** depth})
+        return groups
+
+class ProgressiveUnfreezing:
+    def __init__(self, model, scheduler, every=2):
+        self.model = model
+        self.scheduler = scheduler
+        self.every = every
+        self.epoch = 0
+
+    def step(self):
+        self.scheduler.step()
+        self.epoch += 1
+        n_frozen = max(0, len(self.model.STAGES) - self.epoch // self.every)
+        if n_frozen != self.model.n_frozen:
+            self.model.set_frozen(n_frozen)
+            print(f'Unfroze {self.model.STAGES[n_frozen]}')
+
+    def state_dict(self):
+        return {'scheduler': self.scheduler.state_dict(), 'epoch': self.epoch}
+
+    def load_state_dict(self, state):
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.epoch = state['epoch']
+        self.model.set_frozen(max(0, len(self.model.STAGES) - self.epoch // self.every))
+
+"""The optimizer gets all the parameter groups from the start. The parameters of the frozen stages have no gradient, so SGD just skips them until they are unfrozen."""
+
+def run_progressive(num_epochs=25, resume=False):
+    model_prog = ProgressiveResNet(unshare(registry.get('resnet18'), buffers=True), len(class_names)).to(device)
+    optimizer_prog = optim.SGD(model_prog.param_groups(lr=0.001), lr=0.001, momentum=0.9)
+    prog_scheduler = ProgressiveUnfreezing(model_prog, lr_scheduler.StepLR(optimizer_prog, step_size=7, gamma=0.1), every=3)
+    return train_model(model_prog, nn.CrossEntropyLoss(), optimizer_prog, prog_scheduler, num_epochs=num_epochs,
+                       checkpoint_dir='checkpoints/model_prog', patience=5, resume=resume)
+
+"""## Running everything
+All the steps above are functions now, so importing this file doesn't load any data or train anything. `main()` runs the original tutorial: the finetuning and the fixed feature extractor. The other parts are slow, so they only run if you ask for them with `--steps`, e.g. `--steps finetune export distill` (`export` and `distill` need `finetune`, it is run for them if needed). The trainings start from scratch every time, `--resume` continues them from their checkpoints in `checkpoints/` instead. `--errors DIR` keeps the `ErrorIndex` of the finetuning in `DIR`, `--tta` compares the accuracy with and without test-time augmentation and `--report DIR` writes the `PredictionReport` of the finetuned model on the validation set.
+
+`benchmark_import` measures what importing this file costs in a fresh Python process, which is what every worker pays: `python transferlearning.py --import-benchmark`.
+"""
 
-plt.ioff()
-plt.show()
\ No newline at end of file
+import argparse
+import subprocess
+
+STEPS = ['finetune', 'conv', 'export', 'distill', 'sweep', 'progressive']
+DEFAULT_STEPS = ['finetune', 'conv'] # the original tutorial, the rest is opt-in
+
+def benchmark_import(module='transferlearning', repeat=5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = f'import time; since = time.perf_counter(); import {module}; print(time.perf_counter() - since)'
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.split()[-1]))
+    times.sort()
+    print(f'import {module}: best {times[0] * 1000:.0f} ms, median {times[len(times) // 2] * 1000:.0f} ms')
+    return times
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Transfer learning tutorial: ants vs. bees.')
+    parser.add_argument('--data-dir', default=data_dir)
+    parser.add_argument('--steps', nargs='+', choices=STEPS, default=DEFAULT_STEPS)
+    parser.add_argument('--epochs', type=int, default=25)
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoints of an earlier run')
+    parser.add_argument('--import-benchmark', action='store_true')
+    parser.add_argument('--errors', metavar='DIR', help='record the validation predictions of every epoch of the finetuning in DIR')
+    parser.add_argument('--tta', action='store_true', help='compare the validation accuracy of the finetuned model with and without TTA')
+    parser.add_argument('--tta-budget', type=float, default=None, metavar='MS', help='latency the TTA views may add per batch')
+    parser.add_argument('--report', metavar='DIR', help='write the validation predictions of the finetuned model to DIR')
+    args, _ = parser.parse_known_args(argv)
+    if args.import_benchmark:
+        benchmark_import()
+        return
+
+    import matplotlib.pyplot as plt
+    setup_hardware()
+    setup_plotting()
+    load_data(args.data_dir)
+    show_training_batch()
+    show_architecture()
+
+    model_ft = None
+    if 'finetune' in args.steps or {'export', 'distill'} & set(args.steps) or args.report or args.tta:
+        model_ft = run_finetuning(args.epochs, errors_dir=args.errors, resume=args.resume)
+    if args.tta:
+        tta_accuracy(model_ft, args.data_dir, budget_ms=args.tta_budget)
+    if args.report:
+        prediction_report(model_ft, dataloaders['val'], args.report)
+    if 'conv' in args.steps:
+        run_feature_extractor(args.epochs, resume=args.resume)
+    if 'export' in args.steps:
+        run_export(model_ft)
+    if 'distill' in args.steps:
+        run_distillation(model_ft, args.data_dir)
+    if 'sweep' in args.steps:
+        sweep(n_trials=9, max_epochs=9, data_dir=args.data_dir)
+    if 'progressive' in args.steps:
+        run_progressive(args.epochs, resume=args.resume)
+
+    plt.ioff()
+    plt.show()
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""Helpers shared by the tutorials.
+
+The notebooks started out as separate Colab exports, so code that more than one of them needs was
+copied around. It lives here now and the tutorials import it (they add the root of the repo to
+`sys.path` for that).
+"""
+
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+class DevicePrefetcher:
+    """Wraps a DataLoader and yields its batches already on `device`, loading the next ones in the background."""
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self._buffers = {} # (slot, position) -> pinned tensor
+        self._events = {}  # slot -> CUDA event of the last copy out of that slot
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name): # dataset, batch_size, ... of the loader
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _pinned(self, tensor, slot, position):
+        key = (slot, position)
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = self._buffers[key] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        return buffer.copy_(tensor)
+
+    def _to_device(self, batch, slot):
+        event = self._events.get(slot)
+        if event is not None:
+            event.synchronize() # the buffers of this slot are not being copied anymore
+        moved = [self._pinned(t, slot, i).to(self.device, non_blocking=True) if torch.is_tensor(t) else t
+                 for i, t in enumerate(batch)]
+        self._events[slot] = torch.cuda.Event()
+        self._events[slot].record()
+        return moved
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+        slots = self.depth + 1
+
+        def preload(n):
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(batch, n % slots)
+
+        n = 0
+        next_batch = preload(n)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            for t in batch:
+                if torch.is_tensor(t):
+                    t.record_stream(torch.cuda.current_stream(self.device))
+            n += 1
+            next_batch = preload(n) # starts copying while the caller uses `batch`
+            yield batch
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False # nobody is reading anymore
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put([t.to(self.device) if torch.is_tensor(t) else t for t in batch]):
+                        return
+                put(done)
+            except Exception as e: # raise it in the training loop
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set() # the loop was left early, e.g. visualize_model
+
+
+class ErrorIndex:
+    """Per-sample predictions of every evaluated epoch, saved column by column, with queries for error analysis.
+
+    The first `commit` deletes the epochs of earlier runs in `root`, unless `resume=True`. Only reading an index
+    never deletes anything.
+    """
+
+    COLUMNS = {'index': np.int64, 'label': np.int16, 'pred': np.int16, 'confidence': np.float32, 'loss': np.float32}
+
+    def __init__(self, root, paths=None, class_names=None, resume=False):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        meta_path = os.path.join(root, 'meta.json')
+        if paths is not None or class_names is not None:
+            self.meta = {'paths': None if paths is None else [str(p) for p in paths],
+                         'class_names': None if class_names is None else [str(c) for c in class_names]}
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump(self.meta, f)
+            os.replace(meta_path + '.tmp', meta_path)
+        elif os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'paths': None, 'class_names': None}
+        self._parts = {} # epoch -> batches that are not saved yet
+        self._tables = {} # epoch -> columns, once loaded
+        self._stale = not resume # the epochs on disk belong to another run
+
+    def _file(self, epoch):
+        return os.path.join(self.root, f'epoch_{epoch:04d}.npz')
+
+    def record(self, epoch, indices, labels, preds, confidence, loss):
+        columns = zip(self.COLUMNS, (indices, labels, preds, confidence, loss))
+        batch = {name: (v.detach().cpu().numpy() if torch.is_tensor(v) else np.asarray(v)).astype(self.COLUMNS[name])
+                 for name, v in columns}
+        self._parts.setdefault(epoch, []).append(batch)
+
+    def record_logits(self, epoch, indices, labels, logits):
+        """Same as `record`, from the raw outputs (logits or log-probabilities) of a classifier."""
+        log_probs = torch.log_softmax(logits.detach().float(), dim=1)
+        confidence, preds = log_probs.exp().max(dim=1)
+        loss = torch.nn.functional.nll_loss(log_probs, labels, reduction='none') # the cross entropy of every sample
+        self.record(epoch, indices, labels, preds, confidence, loss)
+
+    def commit(self, epoch):
+        """Writes the rows of `epoch` to disk, sorted by index."""
+        parts = self._parts.pop(epoch, [])
+        if not parts:
+            return
+        if self._stale:
+            for old in self.epochs(): # otherwise table() could return the last epoch of a longer older run
+                os.remove(self._file(old))
+            self._tables = {}
+            self._stale = False
+        table = {name: np.concatenate([p[name] for p in parts]) for name in self.COLUMNS}
+        order = np.argsort(table['index'], kind='stable')
+        table = {name: column[order] for name, column in table.items()}
+        path = self._file(epoch)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **table)
+        os.replace(path + '.tmp', path) # a crash never leaves half an epoch
+        self._tables[epoch] = table
+
+    def epochs(self):
+        return sorted(int(name[6:10]) for name in os.listdir(self.root)
+                      if name.startswith('epoch_') and name.endswith('.npz'))
+
+    def table(self, epoch=None):
+        """The columns of `epoch` (the last one by default) as a dict of numpy arrays."""
+        if epoch is None:
+            epoch = self.epochs()[-1]
+        if epoch not in self._tables:
+            with np.load(self._file(epoch)) as data:
+                self._tables[epoch] = {name: data[name] for name in self.COLUMNS}
+        return self._tables[epoch]
+
+    def _name(self, label):
+        names = self.meta['class_names']
+        return names[label] if names else label
+
+    def rows(self, table, positions):
+        """The rows at `positions` of `table` as dicts, with the file path and the class names."""
+        paths = self.meta['paths']
+        return [{'index': int(table['index'][i]),
+                 'path': paths[table['index'][i]] if paths else None,
+                 'label': self._name(int(table['label'][i])),
+                 'pred': self._name(int(table['pred'][i])),
+                 'confidence': float(table['confidence'][i]),
+                 'loss': float(table['loss'][i])} for i in positions]
+
+    def hardest(self, k=20, epoch=None, wrong_only=False):
+        """The `k` samples with the highest loss."""
+        table = self.table(epoch)
+        candidates = np.flatnonzero(table['label'] != table['pred']) if wrong_only else np.arange(len(table['loss']))
+        order = candidates[np.argsort(-table['loss'][candidates], kind='stable')[:k]]
+        return self.rows(table, order)
+
+    def confusion_pairs(self, epoch=None, k=None):
+        """(label, predicted, count) for the mistakes, the most frequent first."""
+        table = self.table(epoch)
+        n = int(max(table['label'].max(), table['pred'].max())) + 1
+        counts = np.bincount(table['label'].astype(np.int64) * n + table['pred'], minlength=n * n).reshape(n, n)
+        np.fill_diagonal(counts, 0)
+        labels, preds = np.nonzero(counts)
+        order = np.argsort(-counts[labels, preds], kind='stable')[:k]
+        return [(self._name(int(labels[i])), self._name(int(preds[i])), int(counts[labels[i], preds[i]])) for i in order]
+
+    def flips(self, epoch_a, epoch_b):
+        """The samples that were right in `epoch_a` and wrong in `epoch_b` ('broke') and the other way round ('fixed')."""
+        a, b = self.table(epoch_a), self.table(epoch_b)
+        _, ia, ib = np.intersect1d(a['index'], b['index'], assume_unique=True, return_indices=True)
+        right_a = a['label'][ia] == a['pred'][ia]
+        right_b = b['label'][ib] == b['pred'][ib]
+        return {'broke': self.rows(b, ib[right_a & ~right_b]), 'fixed': self.rows(b, ib[~right_a & right_b])}
+
+    def always_wrong(self, min_confidence=0.0, epochs=None):
+        """Samples that are wrong in every epoch, with at least `min_confidence`. Often these have a wrong label."""
+        epochs = self.epochs() if epochs is None else epochs
+        wrong = None
+        for epoch in epochs:
+            table = self.table(epoch)
+            mask = (table['label'] != table['pred']) & (table['confidence'] >= min_confidence)
+            wrong = table['index'][mask] if wrong is None else np.intersect1d(wrong, table['index'][mask])
+        if wrong is None:
+            return []
+        last = self.table(epochs[-1])
+        positions = np.flatnonzero(np.isin(last['index'], wrong))
+        return self.rows(last, positions[np.argsort(-last['confidence'][positions], kind='stable')])